@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+""" Preflight analysis of a workload without simulating it
+
+A single pass over the workload compares the work offered by new checks
+with the bin capacity of the scheduler variables in effect at the time,
+predicts the backlog with a fluid model (work arrives, capacity drains
+it) and counts the tasks the checks will be split into.
+"""
+
+import argparse
+import json
+import sys
+from SMM import jsonstream
+from SMM.simulator import DEFAULT_VARS
+
+def capacityRate(vars):
+    """ Task time the bins can hold per second of simulation (microseconds)
+
+    Every SMI runs one bin per CPU. When the overhead and a full bin
+    don't fit in an SMM period, the next SMI is delayed until the bin is
+    done, so fewer bins run per second.
+    """
+    period = 10**6 // vars['smmpersecond']
+    return vars['cpus'] * vars['binsize'] * 10**6 / max(period, vars['smmoverhead'] + vars['binsize'])
+
+class Analyzer:
+    """ Streaming analysis of workload events in time order """
+    def __init__(self, window):
+        self.__window = window
+        self.__vars = dict(DEFAULT_VARS)
+        self.__time = 0
+        #Per window offered work and capacity (microseconds)
+        self.__offered = []
+        self.__capacity = []
+        self.__checks = {'added':0, 'removed':0}
+        self.__taskCounts = {}
+        self.__tasks = 0
+        self.__taskCost = 0
+        self.__oversized = 0
+        self.__splitters = set()
+        #Cost of the checks that are rescheduled after running, by (group, name)
+        self.__live = {}
+        self.__liveCost = 0
+        self.__peakLive = (0, 0)
+
+    def __windows(self, index):
+        """ Make sure the per window lists reach the given window """
+        while len(self.__offered) <= index:
+            self.__offered.append(0.0)
+            self.__capacity.append(0.0)
+
+    def advance(self, time):
+        """ Move the time forward, adding the capacity of the time passed """
+        rate = capacityRate(self.__vars) / 10**6
+        while self.__time < time:
+            index = self.__time // self.__window
+            end = min(time, (index + 1) * self.__window)
+            self.__windows(index)
+            self.__capacity[index] += rate * (end - self.__time)
+            self.__time = end
+
+    def addChecks(self, checks):
+        """ Account for the work and tasks of new checks """
+        index = self.__time // self.__window
+        self.__windows(index)
+        gran = self.__vars['taskgran']
+        binsize = self.__vars['binsize']
+        self.__splitters.add(self.__vars['checksplitter'])
+        for c in checks:
+            cost = c['cost']
+            #DefaultTasks splits greedily into tasks of the granularity
+            (full, rest) = divmod(cost, gran)
+            tasks = full + (1 if rest else 0)
+            self.__taskCounts[tasks] = self.__taskCounts.get(tasks, 0) + 1
+            self.__tasks += tasks
+            self.__taskCost += cost
+            self.__oversized += (full if gran > binsize else 0) + (1 if rest > binsize else 0)
+            self.__offered[index] += cost
+            if self.__vars['rantask'] == 'reschedule':
+                self.__liveCost += cost - self.__live.get((c['group'], c['name']), 0)
+                self.__live[(c['group'], c['name'])] = cost
+        self.__checks['added'] += len(checks)
+        if self.__liveCost > self.__peakLive[0]:
+            self.__peakLive = (self.__liveCost, len(self.__live))
+
+    def removeChecks(self, checks):
+        """ Account for removed checks """
+        for c in checks:
+            self.__liveCost -= self.__live.pop((c['group'], c['name']), 0)
+        self.__checks['removed'] += len(checks)
+
+    def event(self, e):
+        """ Handle a single workload event """
+        self.advance(e['time'])
+        if e['action'] == 'newcheck':
+            self.addChecks(e['checks'])
+        elif e['action'] == 'removecheck':
+            self.removeChecks(e['checks'])
+        elif e['action'] == 'changevars':
+            self.__vars.update(e['vars'])
+
+    def getData(self, windows=False):
+        """ JSON formatted results of the analysis """
+        offered = sum(self.__offered)
+        capacity = sum(self.__capacity)
+
+        #Fluid model of the backlog of work
+        backlog = 0.0
+        peak = (0.0, 0)
+        series = []
+        for (i, (o, c)) in enumerate(zip(self.__offered, self.__capacity)):
+            backlog = max(0.0, backlog + o - c)
+            if backlog > peak[0]:
+                peak = (backlog, i)
+            series.append({
+                'start':i * self.__window / 10**6,
+                'offered':o,
+                'capacity':c,
+                'utilization':o / c if c > 0 else None,
+                'backlog':backlog,
+            })
+
+        utilizations = [s['utilization'] for s in series if s['utilization'] is not None]
+        mean_task = self.__taskCost / self.__tasks if self.__tasks else 0.0
+        seconds = self.__time / 10**6
+
+        data = {
+            'duration':seconds,
+            'vars':self.__vars,
+            'checks':self.__checks,
+            'tasks':{
+                'count':self.__tasks,
+                'mean_cost':mean_task,
+                'per_check':{str(k):v for (k, v) in sorted(self.__taskCounts.items())},
+                'oversized':self.__oversized,
+            },
+            'load':{
+                'offered':offered,
+                'capacity':capacity,
+                'utilization':offered / capacity if capacity > 0 else None,
+                'peak_utilization':max(utilizations, default=None),
+            },
+            'backlog':{
+                'final':backlog,
+                'final_tasks':backlog / mean_task if mean_task else 0.0,
+                'max':peak[0],
+                'max_time':peak[1] * self.__window / 10**6,
+                'growth_tasks_per_second':(offered - capacity) / mean_task / seconds
+                                          if mean_task and seconds and offered > capacity else 0.0,
+                'drain_seconds':backlog / capacityRate(self.__vars),
+            },
+        }
+        if self.__peakLive[0]:
+            #Rescheduled checks run over and over, what matters is the time to run them all once
+            (live, count) = self.__peakLive
+            data['reschedule'] = {
+                'peak_checks':count,
+                'peak_cost':live,
+                'revisit_seconds':live / capacityRate(self.__vars),
+            }
+        if self.__splitters != {'DefaultTasks'} and self.__splitters:
+            data['warnings'] = ["Task counts assume DefaultTasks, the workload uses {}".format(
+                ", ".join(sorted(self.__splitters)))]
+        if windows:
+            data['windows'] = series
+        return data
+
+def problems(data, max_utilization, max_backlog):
+    """ Reasons why a workload can't be run as intended """
+    found = []
+    if data['tasks']['oversized']:
+        found.append("{} tasks are larger than the bin size and will never run".format(data['tasks']['oversized']))
+    utilization = data['load']['utilization']
+    if utilization is not None and utilization > max_utilization:
+        found.append("Offered load is {:.1%} of capacity".format(utilization))
+    if data['backlog']['drain_seconds'] > max_backlog:
+        found.append("Backlog at the end needs {:.1f}s to drain".format(data['backlog']['drain_seconds']))
+    return found
+
+def analyze(location, window=10**6, windows=False):
+    """ Analyze a workload in a single pass """
+    a = Analyzer(window)
+    with jsonstream.openWorkload(location) as f:
+        for e in jsonstream.iterWorkload(f):
+            a.event(e)
+    return a.getData(windows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the feasibility of a workload without simulating it')
+    parser.add_argument('workload', type=str,
+                        help='Workload to analyze (- for stdin).')
+    parser.add_argument('--window', type=float, default=1.0,
+                        help='Length of the analysis windows (seconds).')
+    parser.add_argument('--windows',
+                        default=False,
+                        action='store_true',
+                        help='Include the per window offered load and backlog.')
+    parser.add_argument('--max-utilization', type=float, default=1.0,
+                        help='Highest acceptable ratio of offered load to capacity.')
+    parser.add_argument('--max-backlog', type=float, default=1.0,
+                        help='Highest acceptable time to drain the backlog at the end (seconds).')
+
+    args = parser.parse_args()
+    window = int(args.window * 10**6)
+    if window < 1:
+        parser.error("--window must be at least a microsecond")
+
+    data = analyze(args.workload, window, args.windows)
+    found = problems(data, args.max_utilization, args.max_backlog)
+    data['feasible'] = not found
+    data['problems'] = found
+    print(json.dumps(data, indent=4, sort_keys=True))
+
+    if found:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
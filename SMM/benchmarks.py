@@ -4,159 +4,400 @@ import sqlite3
 import numpy as np
 import argparse
 import json
+import math
+import glob
+import hashlib
+import functools
+import csv
 import os
 import sys
+from multiprocessing import Pool
+from SMM import log, sketch, timeseries
 
-""" Benchmarking tool to compute various statistics from the Simulation Run DB """
-def taskid(name):
-    """ Helper function to create subquery for getting event type ids """
-    return "(select id from event_type where name = '{}')".format(name)
+""" Benchmarking tool to compute various statistics from the Simulation Run DB
 
-def avghist(data, weights, bins=None):
-    """ Compute the average of data in histogram buckets """
-    if bins is not None:
-        sums = np.histogram(data, weights=weights, bins=bins)[0]
-        (counts, buckets) = np.histogram(data, bins=bins)
-        buckets=bins
-    else:
-        sums = np.histogram(data, weights=weights)[0]
-        (counts, buckets) = np.histogram(data)
+The statistics are computed in two steps. First a set of partial
+aggregates is collected from each database, then the (merged) partial
+aggregates are turned into the reported benchmarks. This allows the
+shards of a sharded log to be collected in parallel.
+"""
+
+#Version of the partial aggregates, bump it whenever they are computed differently
+BENCHMARK_VERSION = 2
+
+#Histogram buckets for the response time of tasks
+COST_BINS = list(np.linspace(0, 50, num=20))
+PRIORITY_BINS = list(range(1, 21))
+
+def moments(data):
+    """ Summarize data in a form that can be merged with other summaries """
+    data = np.asarray(data, dtype=float)
+    if data.size == 0:
+        return {'count':0, 'min':0.0, 'max':0.0, 'mean':0.0, 'm2':0.0}
+
+    mean = np.mean(data)
+    return {
+        'count':int(data.size),
+        'min':float(np.min(data)),
+        'max':float(np.max(data)),
+        'mean':float(mean),
+        'm2':float(np.sum((data - mean) ** 2)),
+    }
 
+def mergemoments(a, b):
+    """ Merge two summaries created by moments """
+    if a['count'] == 0:
+        return b
+    if b['count'] == 0:
+        return a
+
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    return {
+        'count':count,
+        'min':min(a['min'], b['min']),
+        'max':max(a['max'], b['max']),
+        'mean':a['mean'] + delta * b['count'] / count,
+        'm2':a['m2'] + b['m2'] + delta ** 2 * a['count'] * b['count'] / count,
+    }
+
+def stddev(m):
+    """ Standard deviation of a summary created by moments """
+    if m['count'] == 0:
+        return 0.0
+    return math.sqrt(m['m2'] / m['count'])
+
+def histsums(data, weights, bins):
+    """ Compute the sum of weights and counts of data in histogram buckets """
+    sums = np.histogram(data, weights=weights, bins=bins)[0]
+    counts = np.histogram(data, bins=bins)[0]
+    return {'sums':[float(s) for s in sums], 'counts':[int(c) for c in counts]}
+
+def costbuckets(cost):
+    """ Bucket of every cost in COST_BINS, as histsums counts them (-1 outside of them) """
+    bucket = np.searchsorted(COST_BINS, cost, 'right') - 1
+    #Like np.histogram, the last bucket includes its upper edge
+    bucket[cost == COST_BINS[-1]] = len(COST_BINS) - 2
+    bucket[(cost < COST_BINS[0]) | (cost > COST_BINS[-1])] = -1
+    return bucket
+
+def avghist(hist):
+    """ Compute the average of data in histogram buckets """
+    counts = np.array(hist['counts'])
     #elements with zero count will by definition have zero sum, ignore div by zero
     counts[counts == 0] = 1
+    return np.divide(hist['sums'], counts)
+
+class LogColumns:
+    """ The columns of a log database needed by the benchmarks
+
+    Every set of columns is read with a single query the first time
+    it is needed and kept as NumPy arrays for all the benchmarks.
+    Partial aggregates are cached in the benchmark_cache table of the
+    log, keyed by metric, benchmark version and a fingerprint of the
+    log contents, so they are only computed again if they are stale.
+
+    Logs written before the job table existed (schema 1) get their jobs
+    by pairing the add_task and run_task events of every task, as each
+    task was only added once.
+    """
+    def __init__(self, db):
+        self.__conn = sqlite3.connect(db)
+        self.__columns = {}
+        self.__fingerprint = None
+        self.__legacy = not log.hasTable(self.__conn, 'job')
+
+        (version,) = self.__conn.execute("PRAGMA user_version").fetchone()
+        if version < log.SCHEMA_VERSION and not self.__legacy:
+            print("Warning: {} is not indexed, try smmbench --prepare".format(db), file=sys.stderr)
+
+    def __load(self, name, sql, width):
+        """ Load the result of a query as an array per column """
+        if name not in self.__columns:
+            rows = self.__conn.execute(sql).fetchall()
+            self.__columns[name] = np.array(rows, dtype=float).reshape(-1, width).T
+        return self.__columns[name]
+
+    def bins(self):
+        """ Bin id, length and time of every event in a bin (ordered by bin) """
+        return self.__load('bins', """
+        select bin_id, length, time
+        from event
+        where bin_id not null
+        order by bin_id""", 3)
+
+    def jobs(self):
+        """ Cost, priority, add time and run time (NaN if it never ran) of every job """
+        if self.__legacy:
+            return self.__load('jobs', """
+            select task.cost, task.priority, added.time, finished.time
+            from event as added
+            join task on task.id = added.task_id
+            left join (select time, task_id from event
+                       where type_id = (select id from event_type where name = 'run_task')) as finished
+                 on finished.task_id = added.task_id
+            where added.type_id = (select id from event_type where name = 'add_task')""", 4)
+        return self.__load('jobs', """
+        select task.cost, job.priority, job.add_time, job.run_time
+        from job
+        join task on task.id = job.task_id""", 4)
+
+    def fingerprint(self):
+        """ A cheap fingerprint of the contents of the log """
+        if self.__fingerprint is None:
+            c = self.__conn.cursor()
+            summary = (
+                c.execute("PRAGMA user_version").fetchone() +
+                c.execute("SELECT count(*), max(id), max(time) FROM event").fetchone() +
+                (() if self.__legacy else c.execute("SELECT count(*), max(id), max(run_time) FROM job").fetchone()) +
+                c.execute("SELECT count(*), max(id) FROM task").fetchone()
+            )
+            self.__fingerprint = hashlib.sha1(repr(summary).encode()).hexdigest()
+        return self.__fingerprint
+
+    def cached(self):
+        """ Get the cached partial aggregates that are still valid """
+        try:
+            rows = self.__conn.execute(
+                "SELECT metric, value FROM benchmark_cache WHERE version = ? AND fingerprint = ?",
+                (BENCHMARK_VERSION, self.fingerprint())
+            ).fetchall()
+        except sqlite3.OperationalError:
+            #No cache yet
+            return {}
+        return {metric:json.loads(value) for (metric, value) in rows}
+
+    def cache(self, metric, value):
+        """ Cache a partial aggregate in the log (if it is writable) """
+        try:
+            with self.__conn:
+                self.__conn.execute("""
+                CREATE TABLE IF NOT EXISTS benchmark_cache
+                (metric text, version integer, fingerprint text, value text,
+                 PRIMARY KEY (metric, version, fingerprint));
+                """)
+                self.__conn.execute("DELETE FROM benchmark_cache WHERE metric = ?", (metric,))
+                self.__conn.execute(
+                    "INSERT INTO benchmark_cache (metric, version, fingerprint, value) VALUES (?, ?, ?, ?)",
+                    (metric, BENCHMARK_VERSION, self.fingerprint(), json.dumps(value))
+                )
+        except sqlite3.OperationalError:
+            #Read only logs just don't get cached
+            pass
+
+    def close(self):
+        """ Close the database """
+        self.__conn.close()
+
+def partialbins(cols):
+    """ Partial aggregates of the bins that were run """
+    (bin_id, length, time) = cols.bins()
+    if len(bin_id) == 0:
+        return {'lengths':moments([]), 'bin_time':0, 'max_time':None}
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bin_id)) + 1))
+    return {
+        'lengths':moments(np.add.reduceat(length, starts)),
+        'bin_time':int(length.sum()),
+        'max_time':int(time.max()),
+    }
+
+def partialjobs(cols):
+    """ Partial aggregates of the jobs and their response times """
+    (cost, priority, add_time, run_time) = cols.jobs()
+    finished = ~np.isnan(run_time)
+    response = (run_time - add_time)[finished]
+    return {
+        'added':len(cost),
+        'tasks':int(np.count_nonzero(finished)),
+        'response':moments(response),
+        'cost':histsums(cost[finished], response, COST_BINS),
+        'priority':histsums(priority[finished], response, PRIORITY_BINS),
+    }
 
-    bin_means = np.divide(sums, counts)
-    return (bin_means, buckets)
+def partialsketch(cols):
+    """ Partial aggregates of the response time distribution (overall, per priority and per cost) """
+    (cost, priority, add_time, run_time) = cols.jobs()
+    finished = ~np.isnan(run_time)
+    response = (run_time - add_time)[finished]
 
-def binresponsetime(conn):
-    """ Determine the average response time for tasks in bins (histograms) """
-    c = conn.cursor()
-    sql = """
-    select task.cost, task.priority, finished.time - event.time as responsetime, finished.time, event.time
-    from event
-    left join (select time, task_id from event where type_id=""" + taskid("run_task") + """) as finished
-          on event.task_id = finished.task_id
-    left join task on task.id = event.task_id
-    where event.type_id=""" + taskid("add_task") + " order by event.time"
+    overall = sketch.QuantileSketch()
+    overall.add(response)
+    costbucket = costbuckets(cost[finished])
+    inside = costbucket >= 0
+    return {
+        'overall':overall.getData(),
+        'priority':{str(k):v.getData() for (k, v) in sketch.groupedSketches(priority[finished].astype(int), response).items()},
+        'cost':{"{:g}".format(COST_BINS[k]):v.getData() for (k, v) in sketch.groupedSketches(costbucket[inside], response[inside]).items()},
+    }
+
+def mergebins(a, b):
+    """ Merge the partial aggregates of the bins """
+    times = [t for t in (a['max_time'], b['max_time']) if t is not None]
+    return {
+        'lengths':mergemoments(a['lengths'], b['lengths']),
+        'bin_time':a['bin_time'] + b['bin_time'],
+        'max_time':max(times) if times else None,
+    }
+
+def mergejobs(a, b):
+    """ Merge the partial aggregates of the jobs """
+    def mergehist(x, y):
+        return {
+            'sums':[i + j for (i, j) in zip(x['sums'], y['sums'])],
+            'counts':[i + j for (i, j) in zip(x['counts'], y['counts'])],
+        }
+
+    return {
+        'added':a['added'] + b['added'],
+        'tasks':a['tasks'] + b['tasks'],
+        'response':mergemoments(a['response'], b['response']),
+        'cost':mergehist(a['cost'], b['cost']),
+        'priority':mergehist(a['priority'], b['priority']),
+    }
 
-    results = c.execute(sql).fetchall()
+def mergesketch(a, b):
+    """ Merge the partial aggregates of the response time distribution """
+    def mergegroups(x, y):
+        merged = dict(x)
+        for (k, v) in y.items():
+            if k in merged:
+                merged[k] = sketch.fromData(merged[k]).merge(sketch.fromData(v)).getData()
+            else:
+                merged[k] = v
+        return merged
+
+    return {
+        'overall':sketch.fromData(a['overall']).merge(sketch.fromData(b['overall'])).getData(),
+        'priority':mergegroups(a['priority'], b['priority']),
+        'cost':mergegroups(a['cost'], b['cost']),
+    }
 
-    results = np.array(results, dtype=float)
-    finished_results = results[~np.isnan(results[:,2])]
+#Partial aggregates computed from each database and how to merge them
+PARTIALS = {
+    'bins':(partialbins, mergebins),
+    'jobs':(partialjobs, mergejobs),
+    'sketch':(partialsketch, mergesketch),
+}
 
-    cost = avghist(finished_results[:,0], weights=finished_results[:,2], bins=np.linspace(0, 50, num=20))
-    priority = avghist(finished_results[:,1], weights=finished_results[:,2],  bins=list(range(1, 21)))
+def empty():
+    """ Partial aggregates of a database without any events """
+    return {
+        'bins':{'lengths':moments([]), 'bin_time':0, 'max_time':None},
+        'jobs':{
+            'added':0,
+            'tasks':0,
+            'response':moments([]),
+            'cost':histsums([], [], COST_BINS),
+            'priority':histsums([], [], PRIORITY_BINS),
+        },
+        'sketch':{'overall':sketch.QuantileSketch().getData(), 'priority':{}, 'cost':{}},
+    }
 
+def collect(db, refresh=False):
+    """ Collect the partial aggregates of a single database
+
+    Only the partial aggregates missing from the cache are computed,
+    unless refresh is set in which case all of them are.
+    """
+    cols = LogColumns(db)
+    cached = {} if refresh else cols.cached()
+    parts = {}
+    for (name, (partial, _)) in PARTIALS.items():
+        if name in cached:
+            parts[name] = cached[name]
+        else:
+            parts[name] = partial(cols)
+            cols.cache(name, parts[name])
+    cols.close()
+    return parts
+
+def merge(a, b):
+    """ Merge the partial aggregates of two databases """
+    return {name:m(a[name], b[name]) for (name, (_, m)) in PARTIALS.items()}
+
+def binresponsetime(p):
+    """ Determine the average response time for tasks in bins (histograms) """
     r = {
         'responsebin':{
-            'cost':list(cost[0]),
-            'cost_bins':list(cost[1]),
-            'priority':list(priority[0]),
-            'priority_bins':list(map(float, priority[1]))
+            'cost':list(avghist(p['jobs']['cost'])),
+            'cost_bins':COST_BINS,
+            'priority':list(avghist(p['jobs']['priority'])),
+            'priority_bins':list(map(float, PRIORITY_BINS))
         }
     }
     return r
 
-def responsetime(conn):
+def responsetime(p):
     """ Determine the average response time for tasks in bins """
-    c = conn.cursor()
-    results = c.execute("""
-    select finished.time, event.time, finished.time - event.time as responsetime
-    from event
-    left join (select time, task_id from event where type_id=""" + taskid("run_task") + """) as finished
-          on event.task_id = finished.task_id
-    where event.type_id=""" + taskid("add_task")).fetchall()
-
-    results = np.matrix(results, dtype=float)
-    runtimes = results[:,2]
-
-    nones = runtimes == np.array(None)
-    (finished, nofinish) = (runtimes[~np.isnan(runtimes).all(axis=1)], runtimes[np.isnan(runtimes).any(axis=1)])
-
+    finished = p['jobs']['response']
     return {
         "completion":{
-            "finished":finished.size,
-            "dnf":nofinish.size,
+            "finished":finished['count'],
+            "dnf":p['jobs']['added'] - finished['count'],
         },
         "response_times":{
-            "min":np.min(finished),
-            "mean":np.mean(finished),
-            "max":np.max(finished),
-            "std":np.std(finished)
+            "min":finished['min'],
+            "mean":finished['mean'],
+            "max":finished['max'],
+            "std":stddev(finished)
         }
     }
 
-def maxtime(conn):
-    """ Determine the last simulation time """
-    c = conn.cursor()
-    r = c.execute("SELECT max(time) as max_time FROM event WHERE bin_id not null").fetchall()
-    last_time = r[0]['max_time']
-    return last_time
+def responsepercentiles(p):
+    """ Determine the tail latency of tasks overall, per priority and per cost """
+    def summarize(groups):
+        return {k:sketch.percentiles(sketch.fromData(v)) for (k, v) in groups.items()}
 
-def cputime(conn):
-    """ Compute the CPU time of the simulated machine in SMM """
-    c = conn.cursor()
-    r = c.execute("SELECT SUM(length) as total_bin_time FROM event WHERE bin_id not null").fetchall()
-    total_bin_time = r[0]['total_bin_time'];
-    last_time = maxtime(conn)
+    return {
+        "response_percentiles":{
+            "overall":sketch.percentiles(sketch.fromData(p['sketch']['overall'])),
+            "priority":summarize(p['sketch']['priority']),
+            "cost":summarize(p['sketch']['cost']),
+        }
+    }
 
-    cputime = 0
-    if total_bin_time and last_time:
-        cpu_time = total_bin_time / last_time
+def cputime(p):
+    """ Compute the CPU time of the simulated machine in SMM """
+    cpu_time = 0
+    if p['bins']['bin_time'] and p['bins']['max_time']:
+        cpu_time = p['bins']['bin_time'] / p['bins']['max_time']
 
     return {
         "cpu_time":cpu_time
     }
 
-
-def totaltasks(conn):
-    """ Compute the total number of tasks executed """
-    c = conn.cursor()
-    r = c.execute("SELECT count(id) as total_tasks FROM event WHERE type_id = " + taskid("run_task")).fetchall()
-    return r[0]['total_tasks']
-
-def throughput(conn):
+def throughput(p):
     """ Determine the number of tasks per second """
-    c = conn.cursor()
-    last_time = maxtime(conn)
-    total_tasks = totaltasks(conn)
+    tasks_per_second = 0
+    if p['bins']['max_time']:
+        tasks_per_second = p['jobs']['tasks'] / (p['bins']['max_time'] / (10**6))
 
     return {
-        "throughput_tasks_per_second": (total_tasks / (last_time / (10**6)))
+        "throughput_tasks_per_second": tasks_per_second
     }
 
-def throughputbin(conn):
+def throughputbin(p):
     """ Determine the total number of tasks run per bin """
-    c = conn.cursor()
-    bc = bincount(conn)
-    total_tasks = totaltasks(conn)
+    tasks_per_bin = 0
+    if p['bins']['lengths']['count']:
+        tasks_per_bin = p['jobs']['tasks'] / p['bins']['lengths']['count']
+
     return  {
-        "throughput_tasks_per_bin": total_tasks / bc['bins']['count']
+        "throughput_tasks_per_bin": tasks_per_bin
     }
 
-def bincount(conn):
+def bincount(p):
     """ Determine the total bins executed """
-    c = conn.cursor()
-    r = c.execute("""
-    select sum(length) as bin_length
-    from event
-    where bin_id not null
-    group by bin_id""").fetchall()
-    bindata = np.array(r, dtype=float)
-
-    if len(bindata):
-        binfo = (len(bindata), np.min(bindata), np.max(bindata), np.mean(bindata), np.std(bindata) )
-    else:
-        binfo = (0, 0, 0, 0, 0)
-
+    b = p['bins']['lengths']
     return {
         "bins":{
-            "count":float(binfo[0]),
+            "count":float(b['count']),
             "length":{
-                "min":float(binfo[1]),
-                "max":float(binfo[2]),
-                "mean":float(binfo[3]),
-                "std":float(binfo[4]),
+                "min":b['min'],
+                "max":b['max'],
+                "mean":b['mean'],
+                "std":stddev(b),
             }
         }
     }
@@ -169,30 +410,213 @@ def miscdata(conn):
         "meta":{k:str(v) for k,v in r}
     }
 
+def prepare(db):
+    """ Index and analyze a log (or all its shards) for benchmarking """
+    for path in log.shardFiles(db) or [db]:
+        if os.path.exists(path):
+            conn = sqlite3.connect(path)
+            log.finishLog(conn)
+            conn.close()
+
+def report(p):
+    """ Turn the (merged) partial aggregates into the benchmark results """
+    data = {}
+    data.update(bincount(p))
+    data.update(responsetime(p))
+    data.update(binresponsetime(p))
+    data.update(responsepercentiles(p))
+    data.update(cputime(p))
+    data.update(throughput(p))
+    data.update(throughputbin(p))
+    return data
+
+def benchmarks(dbs, jobs=None, refresh=False, combine=False):
+    """ Run all the benchmarks on a list of logs (sharded or not)
+
+    All the databases and shards are collected on a single process pool.
+    If combine is set, the logs are treated as a single run (e.g. the
+    seeds of a configuration) and a single result is returned.
+    """
+    results = []
+    units = []
+    for (i, db) in enumerate(dbs):
+        conn = sqlite3.connect(db)
+        data = miscdata(conn)
+        conn.close()
+
+        shards = log.shardFiles(db)
+        if shards:
+            present = [s for s in shards if os.path.exists(s)]
+            data['meta']['shards'] = str(len(shards))
+            data['meta']['shards_missing'] = str(len(shards) - len(present))
+        else:
+            present = [db]
+
+        results.append(data)
+        units += [(i, path) for path in present]
+
+    paths = [path for (_, path) in units]
+    collector = functools.partial(collect, refresh=refresh)
+    if jobs != 1 and len(paths) > 1:
+        with Pool(jobs) as p:
+            parts = p.map(collector, paths)
+    else:
+        parts = list(map(collector, paths))
+
+    totals = [empty() for db in dbs]
+    for ((i, _), part) in zip(units, parts):
+        totals[i] = merge(totals[i], part)
+
+    if combine:
+        results = [{"meta":{"runs":str(len(dbs))}}]
+        totals = [functools.reduce(merge, totals, empty())]
+
+    for (data, total) in zip(results, totals):
+        data.update(report(total))
+    return results
+
+def benchmark(db, jobs=None, refresh=False):
+    """ Run all the benchmarks on a log (sharded or not) """
+    return benchmarks([db], jobs, refresh)[0]
+
+def expand(patterns):
+    """ Expand any globs in a list of databases
+
+    Shards matched alongside their manifest are left out, as they are
+    benchmarked as part of the manifest.
+    """
+    dbs = []
+    for p in patterns:
+        matches = sorted(glob.glob(p))
+        dbs += matches if matches else [p]
+
+    shards = set()
+    for db in dbs:
+        if os.path.exists(db):
+            shards.update(os.path.normpath(s) for s in log.shardFiles(db))
+    return [db for db in dbs if os.path.normpath(db) not in shards]
+
+def runkey(db, data, keys):
+    """ Key for a run in a combined report, from its misc data or its location """
+    if not keys:
+        return db
+    return "/".join(data['meta'].get(k, '') for k in keys)
+
+def flatten(data, prefix=""):
+    """ Flatten nested results into dotted column names """
+    flat = {}
+    for (k, v) in data.items():
+        name = prefix + str(k)
+        if isinstance(v, dict):
+            flat.update(flatten(v, name + "."))
+        elif isinstance(v, list):
+            flat.update(flatten(dict(enumerate(v)), name + "."))
+        else:
+            flat[name] = v
+    return flat
+
 def main():
     parser = argparse.ArgumentParser(description='Benchmark Enforcement Tool')
-    parser.add_argument('db', type=str,
-                        help='Sqlite Database File')
+    parser.add_argument('db', type=str, nargs='+',
+                        help='Sqlite Database Files (or shard manifests), globs are expanded')
+    parser.add_argument('--jobs', type=int,
+                        default=None,
+                        help='Number of processes used to benchmark logs and shards (default: one per CPU).')
+    parser.add_argument('--prepare',
+                        default=False,
+                        action='store_true',
+                        help='Index and analyze the logs first (for logs of interrupted simulations).')
+    parser.add_argument('--refresh',
+                        default=False,
+                        action='store_true',
+                        help='Ignore the benchmark results cached in the logs.')
+    parser.add_argument('--combine',
+                        default=False,
+                        action='store_true',
+                        help='Merge all the logs into a single report (e.g. runs with different seeds).')
+    parser.add_argument('--timeseries', type=str,
+                        default=None,
+                        help='Also write per window metrics of the run to this NumPy archive (.npz).')
+    parser.add_argument('--window', type=float,
+                        default=100,
+                        help='Window of the time series (milliseconds of simulated time).')
+    parser.add_argument('--key', type=str,
+                        action='append',
+                        help='Misc field used to key runs in a combined report (default: the log location).')
+    parser.add_argument('--format',
+                        default='json',
+                        choices=['json', 'csv'],
+                        help='Output format.')
+    parser.add_argument('--update-cache', type=str,
+                        default=None,
+                        metavar='CACHE_DIR',
+                        help='Copy the benchmark results into the logs of the smmsim cache the logs came from.')
+    parser.add_argument('--cache-size', type=float,
+                        default=1024,
+                        help='Size of the smmsim cache (MiB).')
 
     args = parser.parse_args()
 
-    if not os.path.exists(args.db):
-        print("DB does not exist");
+    dbs = expand(args.db)
+    missing = [db for db in dbs if not os.path.exists(db)]
+    if missing:
+        print("DB does not exist: {}".format(", ".join(missing)));
         sys.exit(1)
 
-    conn = sqlite3.connect(args.db)
-    conn.row_factory = sqlite3.Row
-
-    data = {}
-    data.update(miscdata(conn))
-    data.update(bincount(conn))
-    data.update(responsetime(conn))
-    data.update(binresponsetime(conn))
-    data.update(cputime(conn))
-    data.update(throughput(conn))
-    data.update(throughputbin(conn))
-
-    print(json.dumps(data, indent=4, sort_keys=True))
+    if args.prepare:
+        for db in dbs:
+            prepare(db)
+
+    if args.timeseries:
+        if len(dbs) != 1:
+            print("A time series needs a single run")
+            sys.exit(1)
+        conn = sqlite3.connect((log.shardFiles(dbs[0]) or dbs[0:1])[0])
+        legacy = not log.hasTable(conn, 'job')
+        conn.close()
+        if legacy:
+            print("{} predates log schema {}, re-run smmsim for a time series".format(dbs[0], log.SCHEMA_VERSION))
+            sys.exit(1)
+        timeseries.save(args.timeseries, timeseries.timeseries(dbs[0], int(args.window * 1000)))
+
+    results = benchmarks(dbs, args.jobs, args.refresh, args.combine)
+
+    if args.update_cache is not None:
+        from SMM import cache
+        #Logs reused from the cache then come with their benchmarks
+        result_cache = cache.ResultCache(args.update_cache, int(args.cache_size * 2**20))
+        for db in dbs:
+            key = cache.logKey(db)
+            if key is not None:
+                result_cache.storeBenchmarks(key, db)
+
+    if args.combine:
+        dbs = ["+".join(dbs)]
+
+    if args.format == 'csv':
+        rows = []
+        for (db, data) in zip(dbs, results):
+            row = flatten(data)
+            row['db'] = db
+            row['key'] = runkey(db, data, args.key)
+            rows.append(row)
+        columns = sorted(set().union(*rows) - {'db', 'key'})
+        writer = csv.DictWriter(sys.stdout, ['key', 'db'] + columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    elif (len(args.db) == 1 and dbs == args.db and not args.key) or args.combine:
+        print(json.dumps(results[0], indent=4, sort_keys=True))
+    else:
+        combined = {}
+        runs = {}
+        for (db, data) in zip(dbs, results):
+            key = runkey(db, data, args.key)
+            if key in combined:
+                print("Runs {} and {} have the same key {}, add --key fields to tell them apart".format(runs[key], db, key))
+                sys.exit(1)
+            combined[key] = data
+            runs[key] = db
+        print(json.dumps(combined, indent=4, sort_keys=True))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 #!/usr/bin/env
 import random
-from SMM.scheduler import Bin
+from SMM.scheduler import Bin, Check
 import functools
+import heapq
 
 """
 This is a collection of Bin Packing algorithms to be used with
@@ -42,29 +43,50 @@ class DefaultBin:
     that low priority tasks will starve. Bins will be filled in
     O(n) time where n is the number of available tasks.
     """
+    #Ordering key over the TaskStore arrays (None to always use the list queue)
+    _vectorKey = staticmethod(lambda a: -a['priority'])
+    #Whether a run gives the same results every time (see SMM.cache)
+    deterministic = True
+
     def __init__(self):
         self._queue = []
         self._cmp = lambda x: -x.getPriority()
+        #With a task store the queue is an array of slots ordered by _vectorKey
+        self._store = Check.taskStore if self._vectorKey is not None else None
+        if self._store is not None:
+            import numpy as np
+            self._slots = np.zeros(0, dtype=np.int64)
 
     def getBinKey(self, state, f):
         """ Determine the next bin based on a ordering function
 
         The preferred approach is usually to store the ordered
-        tasks in the queue field.
+        tasks in the queue field. Tasks are taken from the front
+        of the queue until the next one doesn't fit.
         """
         b = Bin()
+        binsize = state.getVar('binsize')
 
-        if len(self._queue) == 0:
-            return b
-
-        while b.getCost() < state.getVar('binsize') and len(self._queue) > 0:
-            front = self._queue[0]
-            if front.getCost() + b.getCost() <= state.getVar('binsize'):
-                b.addTask(front)
-            else:
+        if self._store is not None:
+            import numpy as np
+            if len(self._slots) == 0:
                 return b
-            self._queue = self._queue[1:]
+            cost = np.cumsum(self._store.getArrays()['cost'][self._slots])
+            #A task is taken when it fits and the bin wasn't already full before it
+            n = min(np.searchsorted(cost, binsize, 'right'), np.searchsorted(cost, binsize, 'left') + 1)
+            b.addTasks(self._store.getTasks(self._slots[:n]))
+            self._slots = self._slots[n:]
+            return b
 
+        total = 0
+        n = 0
+        for t in self._queue:
+            if total >= binsize or total + t.getCost() > binsize:
+                break
+            total += t.getCost()
+            n += 1
+        b.addTasks(self._queue[:n])
+        self._queue = self._queue[n:]
         return b
 
     def requestBin(self, state, cpu_id):
@@ -73,9 +95,31 @@ class DefaultBin:
 
     def addTask(self, task):
         """ Adds a task to the current bin packer """
+        if self._store is not None:
+            self.addTasks([task])
+            return
         ix = bisect(self._queue, task, cmp=lambda x, y : self._cmp(x) - self._cmp(y))
         self._queue.insert(ix, task)
 
+    def addTasks(self, tasks):
+        """ Adds a batch of tasks to the current bin packer
+
+        The batch is sorted and merged into the queue in one pass. Both
+        are stable, so the queue ends up the same as when adding the
+        tasks one at a time.
+        """
+        if self._store is not None:
+            import numpy as np
+            arrays = self._store.getArrays()
+            new = self._store.getSlots(tasks)
+            keys = self._vectorKey(arrays)
+            new = new[np.argsort(keys[new], kind='stable')]
+            ix = np.searchsorted(keys[self._slots], keys[new], 'right')
+            self._slots = np.insert(self._slots, ix, new)
+            return
+        new = sorted(tasks, key=self._cmp)
+        self._queue = list(heapq.merge(self._queue, new, key=self._cmp))
+
     def unusedTasks(self):
         """ Return the set of tasks that haven't been placed into a bin
 
@@ -83,15 +127,33 @@ class DefaultBin:
         placed in bins. If they are swapped out, they need to relinquish their
         tasks.
         """
+        if self._store is not None:
+            return self._store.getTasks(self._slots)
         return self._queue
 
     def removeSubCheck(self, subcheck):
-        """ Removes a subcheck from the existing queue of tasks """
-        self._queue = list(filter(lambda t:  t.getCheck() == subcheck, self._queue))
+        """ Removes a subcheck from the existing queue of tasks, returning its tasks """
+        if self._store is not None:
+            check_id = self._store.getCheckId(subcheck)
+            if check_id is None:
+                return []
+            keep = self._store.getArrays()['check'][self._slots] != check_id
+            removed = self._store.getTasks(self._slots[~keep])
+            self._slots = self._slots[keep]
+            return removed
+        removed = [t for t in self._queue if t.getCheck() == subcheck]
+        self._queue = list(filter(lambda t:  t.getCheck() != subcheck, self._queue))
+        return removed
 
     def ageQueue(self):
         """ Ages (i.e. reprioritizes) tasks in the queue """
-        [t.setPriority(t.getPriority() + 1) for t in self._queue]
+        store = Check.taskStore
+        if self._store is not None:
+            store.getArrays()['priority'][self._slots] += 1
+        elif store is not None:
+            store.getArrays()['priority'][store.getSlots(self._queue)] += 1
+        else:
+            [t.setPriority(t.getPriority() + 1) for t in self._queue]
 
 class AgingBin(DefaultBin):
     """ Packs based on a priority queue while aging unused tasks
@@ -114,6 +176,9 @@ class RandomBin(DefaultBin):
 
     Uses a randomly permuted queue to determine the next task selection. The algorithm reads from that queue in sequential order until it is unable to fit the next task in the bin. Bins will be filled in O(n) time where n is the number of available tasks.
     """
+    _vectorKey = None
+    deterministic = False
+
     def __init__(self):
         """ Initialize with random number generator for ordering """
         super().__init__()
@@ -123,6 +188,11 @@ class RandomBin(DefaultBin):
         """ Request a bin based on the current state """
         return super().requestBin(state, cpu_id)
 
+    def addTasks(self, tasks):
+        """ Adds a batch of tasks, each at a random position """
+        for t in tasks:
+            self.addTask(t)
+
 class LeastRecentBin(DefaultBin):
     """ Choose the least recently run task to prioritize.
 
@@ -136,6 +206,8 @@ class LeastRecentBin(DefaultBin):
     number of available tasks.
 
     """
+    _vectorKey = staticmethod(lambda a: a['last'])
+
     def __init__(self):
         """The ordering function should be based on the last time run """
         super().__init__()
@@ -151,6 +223,8 @@ class KnapsackBin(DefaultBin):
     This class will be inherited to build a Knapsack filler based
     on different criteria
     """
+    _vectorKey = None
+
     def requestFillBin(self, criteria, state):
         """ Return a bin based on a criterion function for knapsack value """
         b = Bin()
@@ -213,6 +287,8 @@ class PriorityKnapsackBin(KnapsackBin):
 
 class BinQueue(DefaultBin):
     """ A generic class that maintains queues of bins to be run in the future."""
+    _vectorKey = None
+
     def __init__(self):
         """ Initializes an empty bin queue for storing future bins """
         super().__init__()
@@ -235,15 +311,22 @@ class BinQueue(DefaultBin):
         """ Add a new task with no priority consideration """
         self._queue.append(task)
 
+    def addTasks(self, tasks):
+        """ Add a batch of tasks with no priority consideration """
+        self._queue.extend(tasks)
+
     def unusedTasks(self):
         """ Return the set of tasks that may be in bins but not yet run
         """
         return functools.reduce(lambda x, y : x + y, [b.getTasks() for b in self._binqueue], []) + self._queue
 
     def removeSubCheck(self, subcheck):
-        """ Removes a subcheck from the set of unused tasks """
-        self._queue = list(filter(lambda t:  t.getCheck() == subcheck, self.unusedTasks()))
+        """ Removes a subcheck from the set of unused tasks, returning its tasks """
+        tasks = self.unusedTasks()
+        removed = [t for t in tasks if t.getCheck() == subcheck]
+        self._queue = list(filter(lambda t:  t.getCheck() != subcheck, tasks))
         self._binqueue = []
+        return removed
 
 class LPBinPack(BinQueue):
     """ Linear Programming Bin Packer
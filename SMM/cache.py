@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+""" Cache of simulation logs keyed by the content of the simulation
+
+The key of a simulation is a hash of everything its results depend
+on: the workloads (after decompression), the options of the simulator
+that change the results and the source of the simulator and of the
+bin packers and check splitters the workloads use. Editing one bin
+packer only changes the keys of the simulations that use it.
+Simulations with a bin packer that isn't deterministic (e.g. RandomBin)
+have no key, as another run would give other results.
+
+The cache is a directory of logs named by their key. Least recently
+used logs are evicted once the directory grows over its size limit.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+from SMM import jsonstream, registry
+
+#Modules that every simulation runs
+CORE_MODULES = ['SMM.simulator', 'SMM.scheduler', 'SMM.log', 'SMM.jsonstream', 'SMM.sharedworkload']
+
+#Options of smmsim that change the results
+OPTIONS = ['prefix_groups', 'task_store', 'validate']
+
+NAMES = re.compile(r'"(binpacker|checksplitter)"\s*:\s*"([^"]*)"')
+
+def workloadDigest(h, locations):
+    """ Hash workloads, returning the bin packers and check splitters they name """
+    names = {'binpacker':set(), 'checksplitter':set()}
+    for location in locations:
+        #Only the contents count, not where the workload is
+        h.update(b"\0workload\0")
+        with jsonstream.openWorkload(location) as stream:
+            for line in stream:
+                h.update(line.encode())
+                for (k, v) in NAMES.findall(line):
+                    names[k].add(v)
+    return names
+
+def classSource(cls):
+    """ Source of a class and of the classes it inherits from """
+    return "".join(inspect.getsource(c) for c in cls.__mro__ if c is not object)
+
+def moduleFunctions(module):
+    """ Source of the functions defined at the top level of a module """
+    return "".join(inspect.getsource(f) for (_, f) in inspect.getmembers(module, inspect.isfunction)
+                   if f.__module__ == module.__name__)
+
+def codeDigest(h, binpackers, checksplitters):
+    """ Hash the source of the simulator and of the classes it will use """
+    for m in CORE_MODULES:
+        __import__(m)
+        h.update(inspect.getsource(sys.modules[m]).encode())
+
+    for (plugins, used) in [(registry.BINPACKERS, binpackers), (registry.CHECKSPLITTERS, checksplitters)]:
+        for name in sorted(used):
+            try:
+                cls = plugins.get(name)
+            except KeyError:
+                #The simulation will fail on it
+                continue
+            h.update(name.encode())
+            h.update(classSource(cls).encode())
+            h.update(moduleFunctions(sys.modules[cls.__module__]).encode())
+
+def deterministic(binpackers):
+    """ Do runs with all the named bin packers give the same results every time? """
+    for name in binpackers:
+        try:
+            cls = registry.BINPACKERS.get(name)
+        except KeyError:
+            continue
+        if not getattr(cls, 'deterministic', True):
+            return False
+    return True
+
+def simulationKey(locations, options, shm_digest=None):
+    """ Key of a simulation of workloads with the given options (a dict)
+
+    None if the simulation can't be cached.
+    """
+    from SMM.simulator import DEFAULT_VARS
+    h = hashlib.sha256()
+    names = workloadDigest(h, locations)
+    if shm_digest is not None:
+        h.update(b"shm" + shm_digest.encode())
+    h.update(json.dumps({k:options.get(k) for k in OPTIONS}, sort_keys=True).encode())
+
+    #The defaults are in effect until a workload changes them
+    names['binpacker'].add(DEFAULT_VARS['binpacker'])
+    names['checksplitter'].add(DEFAULT_VARS['checksplitter'])
+    if not deterministic(names['binpacker']):
+        return None
+    codeDigest(h, names['binpacker'], names['checksplitter'])
+    return h.hexdigest()
+
+def markHit(db):
+    """ Record in a log fetched from the cache that it wasn't simulated again """
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.execute("DELETE FROM misc WHERE key = 'cache_hit'")
+        conn.execute("INSERT INTO misc (key, val) VALUES ('cache_hit', 1)")
+    conn.close()
+
+def logKey(db):
+    """ Cache key recorded in a log (None if it has none) """
+    conn = sqlite3.connect(db)
+    try:
+        row = conn.execute("SELECT val FROM misc WHERE key = 'cache_key'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return row[0] if row else None
+
+class ResultCache:
+    """ A directory of simulation logs with least recently used eviction """
+    def __init__(self, directory, max_size=2**30):
+        self.__directory = directory
+        self.__max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def __path(self, key):
+        """ Location of the log of a key """
+        return os.path.join(self.__directory, key + '.db')
+
+    def contains(self, key):
+        """ Is there a log for the key? """
+        return os.path.exists(self.__path(key))
+
+    def fetch(self, key, location):
+        """ Copy the log of a key to location, returns whether it was found """
+        path = self.__path(key)
+        try:
+            shutil.copyfile(path, location)
+        except FileNotFoundError:
+            return False
+        try:
+            #Mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, key, location):
+        """ Store (or replace) the log of a key, evicting old logs if needed """
+        tmp = "{}.{}.tmp".format(self.__path(key), os.getpid())
+        shutil.copyfile(location, tmp)
+        os.replace(tmp, self.__path(key))
+        self.evict()
+
+    def storeBenchmarks(self, key, location):
+        """ Copy the cached benchmark results of a log into the log of a key
+
+        Only the benchmark_cache table is copied, the rest of the log in
+        the cache stays as the simulator wrote it. Returns whether the key
+        had a log and location had benchmark results.
+        """
+        path = self.__path(key)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            shutil.copyfile(path, tmp)
+        except FileNotFoundError:
+            return False
+
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.execute("ATTACH DATABASE ? AS src", (location,))
+            row = conn.execute("SELECT sql FROM src.sqlite_master WHERE type = 'table' AND name = 'benchmark_cache'").fetchone()
+            if row is not None:
+                with conn:
+                    conn.execute("DROP TABLE IF EXISTS main.benchmark_cache")
+                    conn.execute(row[0])
+                    conn.execute("INSERT INTO main.benchmark_cache SELECT * FROM src.benchmark_cache")
+        finally:
+            conn.close()
+
+        if row is None:
+            os.remove(tmp)
+            return False
+        os.replace(tmp, path)
+        self.evict()
+        return True
+
+    def evict(self):
+        """ Remove the least recently used logs until the cache fits its size """
+        entries = []
+        for e in os.scandir(self.__directory):
+            if e.name.endswith('.db'):
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    #Evicted by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.__max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
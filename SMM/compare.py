@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+""" Statistical comparison of two sets of simulation runs
+
+Each set is made of several runs of one configuration (e.g. different
+seeds). For every benchmark metric the relative change of the mean is
+reported with a bootstrap confidence interval, and metrics with a
+threshold fail when the change is a regression beyond the threshold
+with the given confidence.
+"""
+
+import argparse
+import json
+import sys
+import warnings
+import numpy as np
+from SMM import benchmarks
+
+#Whether a larger value of a metric (by prefix) is better (1) or worse (-1)
+DIRECTIONS = [
+    ('response_times.', -1),
+    ('response_percentiles.', -1),
+    ('responsebin.cost.', -1),
+    ('responsebin.priority.', -1),
+    ('completion.dnf', -1),
+    ('completion.finished', 1),
+    ('throughput_', 1),
+]
+
+#Maximum regressions (percent) checked when no thresholds are given
+DEFAULT_THRESHOLDS = {
+    'response_times.mean':5.0,
+    'response_percentiles.overall.p99':10.0,
+    'throughput_tasks_per_second':5.0,
+}
+
+def direction(metric):
+    """ Direction in which a metric improves (0 if it is neutral) """
+    for (prefix, d) in DIRECTIONS:
+        if metric.startswith(prefix):
+            return d
+    return 0
+
+def loadRuns(locations, jobs=None):
+    """ Load the benchmark results of a set of runs
+
+    Locations can be sqlite logs (which are benchmarked) or the JSON
+    output of smmbench, either a single report or a combined one.
+    """
+    runs = []
+    logs = []
+    for location in benchmarks.expand(locations):
+        with open(location, 'rb') as f:
+            header = f.read(16)
+        if header == b"SQLite format 3\x00":
+            logs.append(location)
+            continue
+
+        with open(location) as f:
+            data = json.load(f)
+        if 'meta' in data:
+            runs.append(data)
+        else:
+            runs += list(data.values())
+
+    if logs:
+        runs += benchmarks.benchmarks(logs, jobs)
+    return runs
+
+def metricTable(runs):
+    """ Get the numeric metrics common to all runs as a (runs x metrics) array """
+    if not runs:
+        raise ValueError("No runs to compare")
+    flat = []
+    for r in runs:
+        f = benchmarks.flatten({k:v for (k, v) in r.items() if k != 'meta'})
+        #Histogram bucket edges are not metrics
+        flat.append({k:v for (k, v) in f.items() if isinstance(v, (int, float)) and '_bins.' not in k})
+
+    metrics = sorted(set.intersection(*[set(f) for f in flat]))
+    return (metrics, np.array([[f[m] for m in metrics] for f in flat], dtype=float))
+
+def resampleMeans(table, resamples, rng):
+    """ Means of every metric over bootstrap resamples of the runs
+
+    A resample is drawn as how many times each run is picked, so the means
+    are one (resamples x runs) by (runs x metrics) product.
+    """
+    n = len(table)
+    weights = rng.multinomial(n, [1 / n] * n, resamples) / n
+    return weights @ table
+
+def bootstrap(base, new, resamples, confidence, rng):
+    """ Bootstrap the relative change of the means of every metric
+
+    Both arrays are (runs x metrics), all metrics are resampled at once.
+    Returns the relative change of the means with its confidence interval.
+    """
+    base_means = resampleMeans(base, resamples, rng)
+    new_means = resampleMeans(new, resamples, rng)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = (new.mean(axis=0) - base.mean(axis=0)) / np.abs(base.mean(axis=0))
+        changes = (new_means - base_means) / np.abs(base_means)
+
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        #Metrics with a zero baseline have no relative change
+        warnings.simplefilter('ignore', RuntimeWarning)
+        (low, high) = np.nanpercentile(changes, [alpha * 100, (1 - alpha) * 100], axis=0)
+    return (change, low, high)
+
+def compare(base_runs, new_runs, thresholds, resamples=10000, confidence=0.95, seed=None):
+    """ Compare two sets of runs, returning the result for every metric """
+    (base_metrics, base) = metricTable(base_runs)
+    (new_metrics, new) = metricTable(new_runs)
+    metrics = sorted(set(base_metrics) & set(new_metrics))
+    base = base[:, [base_metrics.index(m) for m in metrics]]
+    new = new[:, [new_metrics.index(m) for m in metrics]]
+
+    rng = np.random.default_rng(seed)
+    (change, low, high) = bootstrap(base, new, resamples, confidence, rng)
+
+    results = {}
+    for (i, m) in enumerate(metrics):
+        d = direction(m)
+        #Regression is the relative change in the direction that makes the metric worse
+        regression = min(-d * low[i], -d * high[i])
+        result = {
+            'base':float(base[:, i].mean()),
+            'new':float(new[:, i].mean()),
+            'change':float(change[i]),
+            'ci':[float(low[i]), float(high[i])],
+        }
+        if m in thresholds and d != 0:
+            result['threshold'] = thresholds[m]
+            result['pass'] = bool(np.isnan(regression) or regression * 100 <= thresholds[m])
+        results[m] = result
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the benchmarks of two sets of runs')
+    parser.add_argument('--base', type=str, nargs='+', required=True,
+                        help='Logs or smmbench JSON results of the baseline runs.')
+    parser.add_argument('--new', type=str, nargs='+', required=True,
+                        help='Logs or smmbench JSON results of the new runs.')
+    parser.add_argument('--threshold', type=str, action='append', default=[],
+                        help='Maximum regression of a metric in percent (METRIC=PCT), may be repeated.')
+    parser.add_argument('--resamples', type=int, default=10000,
+                        help='Number of bootstrap resamples.')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='Confidence of the intervals.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the bootstrap.')
+    parser.add_argument('--all',
+                        default=False,
+                        action='store_true',
+                        help='Show all metrics, not only the ones with thresholds.')
+    parser.add_argument('--json',
+                        default=False,
+                        action='store_true',
+                        help='Output the comparison as JSON.')
+
+    args = parser.parse_args()
+
+    #Given thresholds are checked along with (or override) the defaults
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    given = set()
+    for t in args.threshold:
+        try:
+            (metric, pct) = t.rsplit('=', 1)
+            thresholds[metric] = float(pct)
+        except ValueError:
+            parser.error("Invalid threshold {}, expected METRIC=PCT".format(t))
+        if direction(metric) == 0:
+            parser.error("Metric {} has no direction in which it improves, it can't have a threshold".format(metric))
+        given.add(metric)
+
+    base_runs = loadRuns(args.base)
+    new_runs = loadRuns(args.new)
+    if not base_runs:
+        parser.error("No runs found in --base")
+    if not new_runs:
+        parser.error("No runs found in --new")
+
+    results = compare(base_runs, new_runs, thresholds,
+                      args.resamples, args.confidence, args.seed)
+    unknown = sorted(given - set(results))
+    if unknown:
+        parser.error("Unknown metrics: {}".format(", ".join(unknown)))
+    if not args.all:
+        results = {m:r for (m, r) in results.items() if 'threshold' in r}
+
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+    else:
+        for (m, r) in sorted(results.items()):
+            status = ""
+            if 'threshold' in r:
+                status = "PASS" if r['pass'] else "FAIL (> {:g}%)".format(r['threshold'])
+            print("{:<45} {:>14.4f} {:>14.4f} {:>+9.2%} [{:>+9.2%}, {:>+9.2%}] {}".format(
+                m, r['base'], r['new'], r['change'], r['ci'][0], r['ci'][1], status))
+
+    if not all(r.get('pass', True) for r in results.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+""" Reading and writing streams of JSON workload events
+
+Workloads are streams of JSON objects, one per line when written
+by the tools. Files ending in .gz or .xz are compressed transparently
+and '-' is standard input/output.
+"""
+
+import functools
+import gzip
+import heapq
+import json
+import lzma
+import re
+import sys
+
+#Number of characters read from a stream at a time
+CHUNK_SIZE = 65536
+
+#gzip's default level 9 is several times slower for little gain on workloads
+COMPRESSORS = {
+    '.gz':functools.partial(gzip.open, compresslevel=6),
+    '.xz':lzma.open,
+}
+
+NOT_WHITESPACE = re.compile(r'[^\s]')
+
+def openWorkload(location, mode='r'):
+    """ Open a workload for reading ('r') or writing ('w') as text """
+    if location == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+
+    for (ext, opener) in COMPRESSORS.items():
+        if location.endswith(ext):
+            return opener(location, mode + 't')
+    return open(location, mode)
+
+def peekEndTime(location):
+    """ Time of the endsim event ending a workload file (None if unknown)
+
+    Only the tail of the file is read, so compressed files and standard
+    input are unknown.
+    """
+    if location == '-' or any(location.endswith(ext) for ext in COMPRESSORS):
+        return None
+
+    with open(location, 'rb') as f:
+        f.seek(0, 2)
+        f.seek(max(f.tell() - CHUNK_SIZE, 0))
+        tail = f.read().decode(errors='ignore')
+
+    #The last complete object starting at a brace is the last event (or one of its checks)
+    decoder = json.JSONDecoder()
+    start = tail.rfind('{')
+    while start >= 0:
+        try:
+            (obj, end) = decoder.raw_decode(tail, start)
+        except ValueError:
+            obj = None
+        if isinstance(obj, dict) and 'action' in obj and not NOT_WHITESPACE.search(tail, end):
+            return obj['time'] if obj['action'] == 'endsim' else None
+        start = tail.rfind('{', 0, start)
+    return None
+
+def iterWorkload(stream, interactive=False):
+    """ Iterate over the JSON objects of a stream
+
+    Objects may span chunks or lines and need not be separated by
+    newlines. In interactive mode every line is decoded on its own and
+    decoding errors are reported instead of raised.
+    """
+    decoder = json.JSONDecoder()
+    if interactive:
+        for line in iter(stream.readline, ''):
+            pos = 0
+            while True:
+                m = NOT_WHITESPACE.search(line, pos)
+                if not m:
+                    break
+                try:
+                    (obj, pos) = decoder.raw_decode(line, m.start())
+                except ValueError as e:
+                    print(e)
+                    break
+                yield obj
+        return
+
+    buffer = ""
+    pos = 0
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            m = NOT_WHITESPACE.search(buffer, pos)
+            if not m:
+                pos = len(buffer)
+                break
+            try:
+                (obj, pos) = decoder.raw_decode(buffer, m.start())
+            except ValueError:
+                #Needs more input
+                pos = m.start()
+                break
+            yield obj
+
+    if NOT_WHITESPACE.search(buffer, pos):
+        raise ValueError("Incomplete JSON object at the end of the workload")
+
+def prefixGroups(events, prefix):
+    """ Prefix the check groups of a stream of events """
+    for e in events:
+        if 'checks' in e:
+            e['checks'] = [dict(c, group=prefix + c['group']) for c in e['checks']]
+        yield e
+
+def mergeWorkloads(streams, prefix=False):
+    """ Lazily merge streams of events by time
+
+    Events of the same time keep the order of the streams, so a prelude
+    given first applies before the other events at time zero. The
+    streams' own endsim events are replaced by a single one at the end
+    of the latest. With prefix, the check groups of every stream are
+    prefixed by its index (e.g. '1:group') so names can't collide.
+    """
+    if prefix:
+        streams = [prefixGroups(events, "{}:".format(i)) for (i, events) in enumerate(streams)]
+
+    end = None
+    time = 0
+    for e in heapq.merge(*streams, key=lambda e: e['time']):
+        time = e['time']
+        if e['action'] == 'endsim':
+            end = time
+            continue
+        yield e
+
+    if end is not None:
+        yield {'time':max(end, time), 'action':'endsim'}
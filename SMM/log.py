@@ -1,88 +1,373 @@
 #!/usr/bin/env python3
 import sqlite3
 import os
+import sys
+import json
+import weakref
 
 """ A set of Logging Classes for use with the simulator """
 
 class SimLog(object):
-    """ Logs to stdout the plain text form of the log """
-    def __init__(self, verbose):
+    """ Logs to stdout the plain text form of the log
+
+    Lines are collected in a buffer and written out in large chunks,
+    either when the buffer is full or when flush is called explicitly.
+    Warnings and errors are written out right away.
+    """
+    #Number of lines held before the buffer is written out
+    BUFFER_LINES = 4096
+    #Ordering and format specs of the fields in a plain text event
+    FIELDS = [
+        ("Time", "{:020d}"),
+        ("Event", "{:<10}"),
+        ("Proc", "{:04d}"),
+        ("Bin", "{:08d}"),
+        ("Task", "{}"),
+        ("Length", "{}"),
+        ("Msg", "{}"),
+    ]
+    #Keys of the fields in a JSON event
+    JSON_FIELDS = ["time", "event", "cpu", "bin", "task", "length", "msg"]
+
+    def __init__(self, verbose, fmt='text', stream=None):
         self._verbose = verbose
+        self._fmt = fmt
+        self._stream = stream if stream is not None else sys.stdout
+        self._lines = []
+        self._formatters = {}
+        self._encode = json.JSONEncoder(separators=(',', ':'), default=str).encode
+        self._events = 0
+
+    def _emit(self, line):
+        """ Buffer a line of output """
+        self._lines.append(line)
+        if len(self._lines) >= self.BUFFER_LINES:
+            self.flush()
+
+    def _formatter(self, shape):
+        """ Compile the formatter for events with the given fields present """
+        fmt = ""
+        for (i, ((name, spec), present)) in enumerate(zip(self.FIELDS, shape)):
+            if present:
+                fmt += "{}: {} ".format(name, spec.replace("{", "{" + str(i)))
+        self._formatters[shape] = fmt.format
+        return fmt.format
+
+    def flush(self):
+        """ Write out any buffered lines """
+        if self._lines:
+            self._lines.append("")
+            self._stream.write("\n".join(self._lines))
+            self._lines = []
+        self._stream.flush()
 
     def addMisc(self, key, val):
         """ Miscellaneous informatino notification """
         if self._verbose:
-            print("Misc: {}:{}".format(key, val))
+            if self._fmt == 'json':
+                self._emit(self._encode({"event":"misc", "key":key, "val":val}))
+            else:
+                self._emit("Misc: {}:{}".format(key, val))
 
     def addTask(self, time, task):
         """ A task was added """
+        self._events += 1
         if self._verbose:
             self.printTimeEvent(time, 0, "add_task", task=task)
 
+    def addTasks(self, time, tasks):
+        """ A batch of tasks was added at the same time """
+        for t in tasks:
+            self.addTask(time, t)
+
     def removeTask(self, time, task):
         """ A task was removed """
+        self._events += 1
         if self._verbose:
             self.printTimeEvent(time, 0, "rm_task", task=task)
 
+    def removeTasks(self, time, tasks):
+        """ A batch of tasks was removed at the same time """
+        for t in tasks:
+            self.removeTask(time, t)
+
     def printTimeEvent(self, time, length, event, task=None, cpu=None, bin=None, msg=None):
         """ Print the info about an an event """
+        if not self._verbose:
+            return
+
         bin_id = None
         if bin is not None:
             bin_id = bin.getId()
 
-        if self._verbose:
-            printable = {
-                "Time":("{Time:020d}", time),
-                "Event":("{Event:<10}", event),
-                "Proc":("{Proc:04d}", cpu),
-                "Bin":("{Bin:08d}", bin_id),
-                "Task":("{Task}", task),
-                "Length":("{Length}", length),
-                "Msg":("{Msg}", msg),
-            }
-            order = ["Time", "Event", "Proc", "Bin", "Task", "Length", "Msg"]
-            fmt = ""
-            for o in order:
-                if printable[o][1] is not None:
-                    fmt += "{}: {} ".format(o, printable[o][0])
-
-            items = ({k: v[1] for (k, v) in printable.items()})
-            print(fmt.format(**items))
+        values = (time, event, cpu, bin_id, task, length, msg)
+        if self._fmt == 'json':
+            self._emit(self._encode({k: v for (k, v) in zip(self.JSON_FIELDS, values) if v is not None}))
+        else:
+            shape = tuple(v is not None for v in values)
+            fmt = self._formatters.get(shape)
+            if fmt is None:
+                fmt = self._formatter(shape)
+            self._emit(fmt(*values))
 
     def timeEvent(self, time, length, event, task=None, cpu=None, bin=None, msg=None):
         """ An event occurred """
+        self._events += 1
         self.printTimeEvent(time, length, event, task, cpu, bin, msg)
 
+    def getEventCount(self):
+        """ Number of events logged so far """
+        return self._events
+
     def warning(self, time, msg):
         """ The simulator warned about something """
-        print("{:020d}: Warning {}".format(time, msg))
+        if self._fmt == 'json':
+            self._emit(self._encode({"time":time, "event":"warning", "msg":msg}))
+        else:
+            self._emit("{:020d}: Warning {}".format(time, msg))
+        self.flush()
 
     def error(self, time, msg):
         """ The simulator errored """
-        print("{:020d}: Error {}".format(time, msg))
+        if self._fmt == 'json':
+            self._emit(self._encode({"time":time, "event":"error", "msg":msg}))
+        else:
+            self._emit("{:020d}: Error {}".format(time, msg))
+        self.flush()
+
+    def checkpoint(self, time):
+        """ The simulator is between bins, a safe point to split the log """
+        pass
 
     def endLog(self):
         """ Terminate Log """
-        pass
+        self.flush()
+
+#Version of the log layout, stored in the user_version of every database
+SCHEMA_VERSION = 2
+
+#Indexes built once a log is complete to serve the benchmark queries, by table
+INDEXES = [
+    ('event', "CREATE INDEX IF NOT EXISTS event_bin_length ON event (bin_id, length, time) WHERE bin_id NOT NULL"),
+]
+
+def finishLog(conn):
+    """ Index and analyze a complete log database so it can be queried efficiently
+
+    Logs written before the job table existed are indexed and analyzed
+    too, but keep their old version.
+    """
+    c = conn.cursor()
+    for (table, index) in INDEXES:
+        if hasTable(conn, table):
+            c.execute(index)
+    c.execute("ANALYZE")
+    if hasTable(conn, 'job'):
+        c.execute("PRAGMA user_version = {:d}".format(SCHEMA_VERSION))
+    conn.commit()
+
+def hasTable(conn, name):
+    """ Does a log database have the given table? """
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
+
+def shardPath(location, index):
+    """ Location of a numbered shard next to its manifest """
+    (root, ext) = os.path.splitext(location)
+    return "{}.{:04d}{}".format(root, index, ext)
+
+def shardFiles(location):
+    """ Get the shard files listed in a manifest (empty if not a manifest) """
+    conn = sqlite3.connect(location)
+    try:
+        if not hasTable(conn, 'shard'):
+            return []
+        rows = conn.execute("SELECT path FROM shard ORDER BY id").fetchall()
+    except sqlite3.DatabaseError:
+        return []
+    finally:
+        conn.close()
+    base = os.path.dirname(location)
+    return [os.path.join(base, p) for (p,) in rows]
+
+def removeLog(location):
+    """ Attempt to remove an existing log (and its shards) """
+    if os.path.exists(location):
+        for s in shardFiles(location):
+            removeLog(s)
+    try:
+        os.remove(location)
+    except OSError as e:
+        if e.errno != 2:
+            raise e
+
+class TaskRecords:
+    """ What the Sqlite log keeps about every task: its id and open job
+
+    The id is kept with the priority the task had when it got it and the
+    number of the database that has its row, the job with its id, the
+    task priority and the times it was added and run (None until it is).
+    """
+    def __init__(self):
+        self.__tasks = weakref.WeakKeyDictionary()
+        self.__jobs = {}
+
+    def getTask(self, task):
+        """ Get the (id, priority, database) of a task (None if it has no id yet) """
+        return self.__tasks.get(task)
+
+    def setTask(self, task, record):
+        """ Set the (id, priority, database) of a task """
+        self.__tasks[task] = record
+
+    def startJob(self, task, job_id, priority, time):
+        """ Start a job of a task added at time """
+        self.__jobs[task] = [job_id, priority, time, None]
+
+    def getJobId(self, task):
+        """ Get the id of the open job of a task (None if it has none) """
+        job = self.__jobs.get(task)
+        return job[0] if job is not None else None
+
+    def runJob(self, task, time):
+        """ The open job of a task ran """
+        job = self.__jobs.get(task)
+        if job is not None:
+            job[3] = time
+
+    def popJob(self, task):
+        """ Finish the open job of a task, returning it (None if it has none) """
+        job = self.__jobs.pop(task, None)
+        return tuple(job) if job is not None else None
+
+    def popJobs(self):
+        """ Finish all the open jobs, returning them as (task, job) pairs """
+        jobs = [(task, tuple(job)) for (task, job) in self.__jobs.items()]
+        self.__jobs = {}
+        return jobs
+
+class StoreTaskRecords(TaskRecords):
+    """ Records of the tasks of a TaskStore, kept in columns of the store """
+    #Column of every field, with its type and the value of a task without it
+    COLUMNS = [
+        ('log_task', 'int64', -1),
+        ('log_priority', 'int32', 0),
+        ('log_database', 'int32', -1),
+        ('log_job', 'int64', -1),
+        ('log_job_priority', 'int32', 0),
+        ('log_add', 'int64', 0),
+        ('log_run', 'int64', -1),
+    ]
+
+    def __init__(self, store):
+        self.__store = store
+        for (name, dtype, fill) in StoreTaskRecords.COLUMNS:
+            store.addColumn(name, dtype, fill)
+
+    def getTask(self, task):
+        a = self.__store.getArrays()
+        slot = task.getSlot()
+        if a['log_task'][slot] < 0:
+            return None
+        return (int(a['log_task'][slot]), int(a['log_priority'][slot]), int(a['log_database'][slot]))
+
+    def setTask(self, task, record):
+        a = self.__store.getArrays()
+        slot = task.getSlot()
+        (a['log_task'][slot], a['log_priority'][slot], a['log_database'][slot]) = record
+
+    def startJob(self, task, job_id, priority, time):
+        a = self.__store.getArrays()
+        slot = task.getSlot()
+        (a['log_job'][slot], a['log_job_priority'][slot], a['log_add'][slot], a['log_run'][slot]) = (job_id, priority, time, -1)
+
+    def getJobId(self, task):
+        job_id = int(self.__store.getArrays()['log_job'][task.getSlot()])
+        return job_id if job_id >= 0 else None
+
+    def runJob(self, task, time):
+        a = self.__store.getArrays()
+        slot = task.getSlot()
+        if a['log_job'][slot] >= 0:
+            a['log_run'][slot] = time
+
+    def __job(self, slot):
+        """ The open job of a slot as a tuple """
+        a = self.__store.getArrays()
+        run_time = int(a['log_run'][slot])
+        return (int(a['log_job'][slot]), int(a['log_job_priority'][slot]), int(a['log_add'][slot]),
+                run_time if run_time >= 0 else None)
+
+    def popJob(self, task):
+        slot = task.getSlot()
+        if self.__store.getArrays()['log_job'][slot] < 0:
+            return None
+        job = self.__job(slot)
+        self.__store.getArrays()['log_job'][slot] = -1
+        return job
+
+    def popJobs(self):
+        slots = self.__store.getLiveSlots()
+        slots = slots[self.__store.getArrays()['log_job'][slots] >= 0]
+        jobs = [(task, self.__job(task.getSlot())) for task in self.__store.getTasks(slots)]
+        self.__store.getArrays()['log_job'][slots] = -1
+        return jobs
 
 class SqliteLog(SimLog):
-    """ A Sqlite Log that is stored in a specified file """
-    def __init__(self, verbose, location):
-        super().__init__(verbose)
-        self.__tasks = {}
+    """ A Sqlite Log that is stored in a specified file
+
+    Every task gets a stable id for as long as it exists, while every
+    time it is added to the scheduler a new job is started. The job row
+    is written once the job is removed (or the log ends) and holds the
+    times the job was added and run.
+
+    If a shard length is given, the location is a manifest and the
+    events are stored in one database per window of simulated time.
+    Each shard holds a copy of the tasks it references so it can be
+    benchmarked, archived or deleted independently of the others.
+
+    With a TaskStore the records of the tasks are kept in columns of
+    the store rather than in dicts (see StoreTaskRecords).
+    """
+    def __init__(self, verbose, location, fmt='text', shard_length=None, store=None):
+        super().__init__(verbose, fmt)
+        self.__records = StoreTaskRecords(store) if store is not None else TaskRecords()
+        #Number of the database being written, see __taskId
+        self.__logged = -1
         self.__events = {}
         self.__eventid = 0
         self.__taskid = 0
+        self.__jobid = 0
+        self.__location = location
+        self.__shard_length = shard_length
+        self.__shard = None
+
+        removeLog(location)
 
-        #Attempt to remove existing log
-        try:
-            os.remove(location)
-        except OSError as e:
-            if e.errno != 2:
-                raise e
+        if shard_length:
+            self.__manifest = sqlite3.connect(location)
+            self.__manifest.execute("""
+            CREATE TABLE misc
+            (key text, val text);
+            """
+            )
+            self.__manifest.execute("""
+            CREATE TABLE shard
+            (id integer primary key, path text, start_time integer, end_time integer);
+            """
+            )
+            self.__manifest.execute("PRAGMA user_version = {:d}".format(SCHEMA_VERSION))
+            self.__misc = self.__manifest.cursor()
+            self.__openShard(0)
+        else:
+            self.__conn = self.__createLog(location)
+            self.__misc = self.__cursor
 
-        self.__conn = sqlite3.connect(location)
-        self.__cursor = self.__conn.cursor()
+    def __createLog(self, location):
+        """ Create a fresh log database with all the tables """
+        conn = sqlite3.connect(location)
+        self.__cursor = conn.cursor()
+        self.__loggedEvents = set()
+        self.__logged += 1
         c = self.__cursor
 
         #Create various tables
@@ -95,6 +380,7 @@ class SqliteLog(SimLog):
             cpu_id integer default null,
             bin_id integer default null,
             task_id integer default null,
+            job_id integer default null,
             length integer default null,
             msg text default null
         );
@@ -105,6 +391,11 @@ class SqliteLog(SimLog):
         """
         )
         c.execute("""
+        CREATE TABLE job
+        (id integer primary key, task_id integer, priority integer, add_time integer, run_time integer default null);
+        """
+        )
+        c.execute("""
         CREATE TABLE event_type
         (id int primary key, name text);
         """
@@ -115,65 +406,182 @@ class SqliteLog(SimLog):
         (key text, val text);
         """
         )
+        return conn
+
+    def __openShard(self, time):
+        """ Start a new shard for the window containing time """
+        if self.__shard is None:
+            self.__shard = 0
+        else:
+            self.__closeShard()
+            self.__shard += 1
+
+        self.__shardStart = time
+        self.__shardEnd = (time // self.__shard_length + 1) * self.__shard_length
+        path = shardPath(self.__location, self.__shard)
+        removeLog(path)
+        self.__conn = self.__createLog(path)
+        self.__cursor.executemany(
+            "INSERT INTO misc (key, val) VALUES (?, ?);",
+            [('shard', self.__shard), ('shard_start', self.__shardStart), ('shard_end', self.__shardEnd)]
+        )
+        self.__misc.execute(
+            "INSERT INTO shard (id, path, start_time, end_time) VALUES (?, ?, ?, ?);",
+            (self.__shard, os.path.basename(path), self.__shardStart, self.__shardEnd)
+        )
+        self.__manifest.commit()
+
+    def __closeShard(self):
+        """ Finish off the current shard """
+        self.__conn.commit()
+        finishLog(self.__conn)
+        self.__conn.close()
+
+    def checkpoint(self, time):
+        """ Move on to the next shard once its window of time has passed """
+        if self.__shard_length and time >= self.__shardEnd:
+            self.__openShard(time)
 
     def addMisc(self, key, val):
         """ Log Miscellaneous information """
         if self._verbose:
             super().addMisc(key, val)
 
-        self.__cursor.execute(
+        self.__misc.execute(
             "INSERT INTO misc (key, val) VALUES (?, ?);",
             (key, val)
         )
 
 
-    def addTask(self, time, task):
-        """ Log task addition """
-        i = self.__taskid
-        self.__taskid += 1
+    def __taskId(self, task):
+        """ Get the stable id of a task, making sure the current log has its row
+
+        The number of the database (shard) whose task table has the task
+        is kept with its id, so nothing is held for tasks that no longer
+        exist.
+        """
+        record = self.__records.getTask(task)
+        if record is not None:
+            (task_id, priority, logged) = record
+        else:
+            (task_id, priority, logged) = (self.__taskid, task.getPriority(), None)
+            self.__taskid += 1
+
+        if logged != self.__logged:
+            self.__records.setTask(task, (task_id, priority, self.__logged))
+            self.__cursor.execute(
+                "INSERT INTO task (id, name, priority, cost) VALUES (?, ?, ?, ?);",
+                (task_id, str(task), priority, task.getCost())
+            )
+        return task_id
 
+    def __logJob(self, task, job):
+        """ Write out a job that is no longer running """
+        (job_id, priority, add_time, run_time) = job
         self.__cursor.execute(
-            "INSERT INTO task (id, name, priority, cost) VALUES (?, ?, ?, ?);",
-            (i, str(task), task.getPriority(), task.getCost())
+            "INSERT INTO job (id, task_id, priority, add_time, run_time) VALUES (?, ?, ?, ?, ?);",
+            (job_id, self.__taskId(task), priority, add_time, run_time)
         )
-        self.__tasks[task] = i
+
+    def addTask(self, time, task):
+        """ Log task addition, which starts a new job of the task """
+        self.__records.startJob(task, self.__jobid, task.getPriority(), time)
+        self.__jobid += 1
 
         self.timeEvent(time, 0, "add_task", task=task)
 
     def removeTask(self, time, task):
-        """ Log task removal """
+        """ Log task removal, which finishes the job of the task """
         self.timeEvent(time, 0, "rm_task", task=task)
-        del self.__tasks[task]
+        self.__logJob(task, self.__records.popJob(task))
+
+    def removeTasks(self, time, tasks):
+        """ Log the removal of a batch of tasks (e.g. of a removed check) with a single insert """
+        event_id = self.__eventTypeId("rm_task")
+        rows = []
+        for task in tasks:
+            if self._verbose:
+                self.printTimeEvent(time, 0, "rm_task", task=task)
+            job = self.__records.popJob(task)
+            rows.append((time, event_id, self.__taskId(task), job[0] if job is not None else None))
+            if job is not None:
+                self.__logJob(task, job)
+
+        self.__cursor.executemany(
+            "INSERT INTO event (time, type_id, task_id, job_id, length) VALUES (?, ?, ?, ?, 0);",
+            rows
+        )
+        self._events += len(rows)
+
+    def addTasks(self, time, tasks):
+        """ Log the addition of a batch of tasks with a single insert """
+        event_id = self.__eventTypeId("add_task")
+        rows = []
+        for task in tasks:
+            if self._verbose:
+                self.printTimeEvent(time, 0, "add_task", task=task)
+            self.__records.startJob(task, self.__jobid, task.getPriority(), time)
+            rows.append((time, event_id, self.__taskId(task), self.__jobid))
+            self.__jobid += 1
+
+        self.__cursor.executemany(
+            "INSERT INTO event (time, type_id, task_id, job_id, length) VALUES (?, ?, ?, ?, 0);",
+            rows
+        )
+        self._events += len(rows)
+
+    def __eventTypeId(self, event):
+        """ Get the id of an event type, logging the type on first use """
+        if event not in self.__events:
+            self.__events[event] = self.__eventid
+            self.__eventid += 1
+
+        event_id = self.__events[event]
+        if event_id not in self.__loggedEvents:
+            self.__loggedEvents.add(event_id)
+            self.__cursor.execute(
+                "INSERT INTO event_type (id, name) VALUES (?, ?);",
+                (event_id, event)
+            )
+        return event_id
 
     def timeEvent(self, time, length, event, task=None, cpu=None, bin=None, msg=None):
         """ Log event occured """
+        self._events += 1
         if self._verbose:
-            super().timeEvent(time, length, event, task, cpu, bin, msg)
+            self.printTimeEvent(time, length, event, task, cpu, bin, msg)
 
         if bin:
             bin_id = bin.getId()
         else:
             bin_id = None
 
-        if event not in self.__events:
-            self.__events[event] = self.__eventid
-            self.__cursor.execute(
-                "INSERT INTO event_type (id, name) VALUES (?, ?);",
-                (self.__eventid, event)
-            )
-            self.__eventid += 1
-
-        event_id = self.__events[event]
+        event_id = self.__eventTypeId(event)
         task_id = None
+        job_id = None
         if task is not None:
-            task_id = self.__tasks[task]
+            task_id = self.__taskId(task)
+            job_id = self.__records.getJobId(task)
+            if event == "run_task":
+                self.__records.runJob(task, time)
 
         self.__cursor.execute(
-            "INSERT INTO event (time, cpu_id, bin_id, type_id, task_id, length, msg) VALUES (?, ?, ?, ?, ?, ?, ?);",
-            (time, cpu, bin_id, event_id, task_id, length, msg)
+            "INSERT INTO event (time, cpu_id, bin_id, type_id, task_id, job_id, length, msg) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+            (time, cpu, bin_id, event_id, task_id, job_id, length, msg)
         )
 
     def endLog(self):
         """End the log by cleaning up the database connection """
-        self.__conn.commit()
-        self.__conn.close()
+        #Jobs that never got removed did not finish
+        for (task, job) in self.__records.popJobs():
+            self.__logJob(task, job)
+
+        if self.__shard_length:
+            self.__closeShard()
+            self.__manifest.commit()
+            self.__manifest.close()
+        else:
+            self.__conn.commit()
+            finishLog(self.__conn)
+            self.__conn.close()
+        super().endLog()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+""" Profiling of a whole simulation
+
+A cProfile of the run is written to the given file (for pstats,
+snakeviz, ...) while a SIGPROF timer samples the Python stack, which
+is written next to it in the collapsed format of flame graph tools
+(one 'outer;inner count' line per distinct stack).
+"""
+
+import cProfile
+import os
+import pstats
+import signal
+
+def collapsedPath(path):
+    """ Location of the collapsed stacks that go with a profile """
+    return os.path.splitext(path)[0] + '.folded'
+
+def frameName(code):
+    """ Name of a function in a collapsed stack """
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class Profiler:
+    """ cProfile and a stack sampler running together
+
+    The sampler needs setitimer, where it's missing only the cProfile
+    is taken.
+    """
+    def __init__(self, path, interval=0.001):
+        self.__path = path
+        self.__interval = interval
+        self.__profile = cProfile.Profile()
+        self.__stacks = {}
+        self.__samples = 0
+        self.__handler = None
+
+    def __sample(self, signum, frame):
+        """ Count the stack the process was in when the timer fired """
+        names = []
+        while frame is not None:
+            names.append(frameName(frame.f_code))
+            frame = frame.f_back
+        stack = ";".join(reversed(names))
+        self.__stacks[stack] = self.__stacks.get(stack, 0) + 1
+        self.__samples += 1
+
+    def start(self):
+        """ Start profiling """
+        if hasattr(signal, 'setitimer'):
+            self.__handler = signal.signal(signal.SIGPROF, self.__sample)
+            signal.setitimer(signal.ITIMER_PROF, self.__interval, self.__interval)
+        self.__profile.enable()
+
+    def stop(self):
+        """ Stop profiling and write out the profile and the collapsed stacks """
+        self.__profile.disable()
+        if self.__handler is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.__handler)
+            self.__handler = None
+
+            with open(collapsedPath(self.__path), 'w') as f:
+                for (stack, count) in sorted(self.__stacks.items()):
+                    f.write("{} {}\n".format(stack, count))
+
+        self.__profile.dump_stats(self.__path)
+
+    def getSamples(self):
+        """ Number of stack samples taken """
+        return self.__samples
+
+    def getTop(self, n=20):
+        """ The n functions with the most time spent in themselves """
+        stats = pstats.Stats(self.__profile).stats
+        top = sorted(stats.items(), key=lambda s: s[1][2], reverse=True)[:n]
+        #Built in functions have no file
+        return [{
+            'function':name if filename == '~' else "{}:{}({})".format(os.path.basename(filename), line, name),
+            'calls':calls,
+            'tottime':tottime,
+            'cumtime':cumtime,
+        } for ((filename, line, name), (primitive, calls, tottime, cumtime, callers)) in top]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+""" Progress reports of a running simulation
+
+Every few seconds of wall time a report is written with the simulated
+time against the end of the workload (when known), the speed of the
+simulation (simulated seconds per wall second), the time left, the
+depth of the bin packer's queue, the rate of logged events and the
+resident memory. Reports go to stderr as text ('-') or as JSON lines
+to a file or an open file descriptor ('fd:N').
+"""
+
+import json
+import os
+import sys
+import time
+
+def openTarget(target):
+    """ Open the destination of the reports, returning (stream, as JSON) """
+    if target == '-':
+        return (sys.stderr, False)
+    if target.startswith('fd:'):
+        return (os.fdopen(int(target[3:]), 'w', buffering=1, closefd=False), True)
+    return (open(target, 'w', buffering=1), True)
+
+def residentMemory():
+    """ Current resident set size of the process (bytes, None if unknown) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Progress:
+    """ Periodic reporter of the progress of a simulation
+
+    The simulator calls update between bins, which only reads the clock
+    until the interval has passed.
+    """
+    def __init__(self, target, interval=5.0, endtime=None):
+        (self.__stream, self.__json) = openTarget(target)
+        self.__interval = interval
+        self.__endtime = endtime
+        self.__start = time.monotonic()
+        self.__next = self.__start + interval
+        self.__last = (self.__start, 0, 0)
+
+    def update(self, state):
+        """ Report if the interval has passed """
+        now = time.monotonic()
+        if now >= self.__next:
+            self.report(state, now)
+            self.__next = now + self.__interval
+
+    def report(self, state, now=None, done=False):
+        """ Write a report of the current state """
+        if now is None:
+            now = time.monotonic()
+        simtime = state.getTime()
+        events = state.getLogger().getEventCount()
+        (last_wall, last_sim, last_events) = self.__last
+        self.__last = (now, simtime, events)
+
+        wall = now - self.__start
+        elapsed = max(now - last_wall, 1e-9)
+        overall = simtime / 10**6 / wall if wall > 0 else None
+        data = {
+            'pid':os.getpid(),
+            'wall':wall,
+            'time':simtime / 10**6,
+            'end':self.__endtime / 10**6 if self.__endtime is not None else None,
+            'speed':(simtime - last_sim) / 10**6 / elapsed,
+            'eta':None,
+            'queue':{state.getVar('binpacker'):len(state.getPacker().unusedTasks())},
+            'events_per_second':(events - last_events) / elapsed,
+            'rss':residentMemory(),
+            'done':done,
+        }
+        if self.__endtime is not None and overall:
+            data['eta'] = max(self.__endtime - simtime, 0) / 10**6 / overall
+
+        if self.__json:
+            self.__stream.write(json.dumps(data, sort_keys=True) + "\n")
+        else:
+            end = "{:.1f}s".format(data['end']) if data['end'] is not None else "?"
+            eta = "{:.0f}s".format(data['eta']) if data['eta'] is not None else "?"
+            rss = "{:.0f}MiB".format(data['rss'] / 2**20) if data['rss'] is not None else "?"
+            queue = " ".join("{}={}".format(k, v) for (k, v) in data['queue'].items())
+            self.__stream.write("[{:.1f}s] sim {:.1f}s/{} speed {:.2f}x eta {} queue {} events {:.0f}/s rss {}\n".format(
+                wall, data['time'], end, data['speed'], eta, queue, data['events_per_second'], rss))
+        self.__stream.flush()
+
+    def close(self, state):
+        """ Write the final report """
+        self.report(state, done=True)
+        if self.__stream is not sys.stderr:
+            self.__stream.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+""" Registry of the bin packers and check splitters by name
+
+The built in classes come from the modules of the package, any other
+package can add its own with entry points, e.g. in its setup.py:
+
+    entry_points={
+        'smm.binpackers': ['MyBin = mypackage.bins:MyBin'],
+    }
+
+Nothing is imported until it is needed: looking up a built in class
+imports its module, entry points are only read for other names and
+only loaded when they are looked up.
+"""
+
+import sys
+
+class Registry:
+    """ Classes of a module defining a method, and of an entry point group """
+    def __init__(self, module, group, method):
+        self.__module = module
+        self.__group = group
+        self.__method = method
+        self.__builtins = None
+        self.__entryPoints = None
+        self.__loaded = {}
+
+    def __builtin(self):
+        """ The built in classes by name """
+        if self.__builtins is None:
+            __import__(self.__module)
+            self.__builtins = {name:c for (name, c) in vars(sys.modules[self.__module]).items()
+                               if isinstance(c, type) and self.__method in c.__dict__}
+        return self.__builtins
+
+    def __entries(self):
+        """ The entry points of the group by name """
+        if self.__entryPoints is None:
+            from importlib import metadata
+            eps = metadata.entry_points()
+            if hasattr(eps, 'select'):
+                eps = eps.select(group=self.__group)
+            else:
+                #Before Python 3.10
+                eps = eps.get(self.__group, [])
+            self.__entryPoints = {ep.name:ep for ep in eps}
+        return self.__entryPoints
+
+    def names(self):
+        """ Names of all the classes """
+        return sorted(set(self.__builtin()) | set(self.__entries()))
+
+    def get(self, name):
+        """ Get a class by name (built in classes take precedence) """
+        builtins = self.__builtin()
+        if name in builtins:
+            return builtins[name]
+        if name not in self.__loaded:
+            if name not in self.__entries():
+                raise KeyError("No {} named {}".format(self.__group, name))
+            self.__loaded[name] = self.__entries()[name].load()
+        return self.__loaded[name]
+
+    def classes(self):
+        """ All the classes by name (loads every entry point) """
+        return {name:self.get(name) for name in self.names()}
+
+BINPACKERS = Registry('SMM.binpackers', 'smm.binpackers', 'requestBin')
+CHECKSPLITTERS = Registry('SMM.checksplitters', 'smm.checksplitters', 'splitChecks')
@@ -1,35 +1,30 @@
 #!/usr/bin/env python3
-import inspect
-import sys
-import subprocess
+from SMM import registry
 
 """ This module contains general sets of useful pieces that are
 specific to scheduling (not neccesarily simulation) and other
 general helpful functions.
 """
 def get_git_revision_hash():
-    """ Gets the current repo commit hash """
-    return subprocess.check_output(['git', 'rev-parse', 'HEAD']).rstrip()
-
-def classmembers(module):
-    """ Gets the classmembers of a specific module """
-    return inspect.getmembers(sys.modules[module], inspect.isclass)
+    """ Gets the commit hash of the code
+
+    The hash is recorded in SMM/_version.py when the package is
+    installed, a checkout that isn't installed asks git.
+    """
+    try:
+        from SMM._version import VERSION
+        return VERSION
+    except ImportError:
+        import subprocess
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().rstrip()
 
 def getBinPackers():
-    """ Gets a list of all the bin packers """
-    import SMM.binpackers
-    binpackers = classmembers("SMM.binpackers")
-    binpackers = filter(lambda x : 'requestBin' in x[1].__dict__, binpackers)
-    binpackers = dict(binpackers)
-    return binpackers
+    """ Gets a list of all the bin packers (see SMM.registry) """
+    return registry.BINPACKERS.classes()
 
 def getCheckSplitters():
-    """ Gets a list of all the check splitters """
-    import SMM.checksplitters
-    checksplitters = classmembers("SMM.checksplitters")
-    checksplitters = filter(lambda x : 'splitChecks' in x[1].__dict__, checksplitters)
-    checksplitters = dict(checksplitters)
-    return checksplitters
+    """ Gets a list of all the check splitters (see SMM.registry) """
+    return registry.CHECKSPLITTERS.classes()
 
 class CheckGroup:
     """ A check group is a named group of collected checks """
@@ -63,6 +58,10 @@ class CheckGroup:
         """ Get the name of the check group """
         return self.__name
 
+    def isEmpty(self):
+        """ Does the group have no subchecks left? """
+        return len(self.__subchecks) == 0
+
     def removeSubCheck(self, name):
         """ Removes the subcheck from the group """
         c = None
@@ -81,6 +80,14 @@ class CheckGroup:
 
 class Check:
     """ A check has an associated priority, cost and will be split into tasks """
+    #Columnar store for the tasks of all checks (None for plain Task objects)
+    taskStore = None
+
+    @staticmethod
+    def setTaskStore(store):
+        """ Make new tasks in a TaskStore (or plain Tasks with None) """
+        Check.taskStore = store
+
     def __init__(self, name, priority, cost):
         self.__name = name
         self.__cost = cost
@@ -97,6 +104,8 @@ class Check:
 
     def makeTask(self, index, cost, time):
         """ Makes a task based on a slice of the Check """
+        if Check.taskStore is not None:
+            return Check.taskStore.addTask(self, index, cost, time)
         return Task(self, index, cost, time)
 
     def getCost(self):
@@ -154,7 +163,7 @@ class Task:
 
     def reset(self):
         """ Reset the priority to it's initial value """
-        self.__prioirity = self.__subcheck.getPriority()
+        self.__priority = self.__subcheck.getPriority()
 
     def getCost(self):
         """ Get the cost of the task """
@@ -186,6 +195,195 @@ class Task:
     def __repr__(self):
         return self.__str__()
 
+class TaskStore:
+    """ Columnar storage of tasks
+
+    The cost, priority, last run time, check and state of every task
+    are kept in NumPy arrays indexed by the task's slot, and tasks are
+    handed out as StoredTask handles with the Task interface. Handles
+    are made on demand and equal when they have the same slot, so
+    nothing but the arrays is kept per task: bin packers queue slots
+    (see getArrays, getSlots and getTasks) and other users of the tasks
+    can add their own columns (see addColumn).
+
+    Slots of released tasks (and ids of checks without tasks) are reused,
+    so the store only grows with the number of tasks alive at once.
+    """
+    FREE = 0
+    LIVE = 1
+
+    def __init__(self, capacity=1024):
+        import numpy as np
+        self.__size = 0
+        self.__arrays = {
+            'cost':np.zeros(capacity, dtype=np.int64),
+            'priority':np.zeros(capacity, dtype=np.int32),
+            'last':np.zeros(capacity, dtype=np.int64),
+            'check':np.zeros(capacity, dtype=np.int32),
+            'index':np.zeros(capacity, dtype=np.int32),
+            'state':np.zeros(capacity, dtype=np.int8),
+        }
+        #Value of the added columns for new tasks
+        self.__fills = {}
+        self.__free = []
+        #Checks by id with the number of their live tasks
+        self.__checks = []
+        self.__checkTasks = []
+        self.__checkIds = {}
+        self.__freeChecks = []
+
+    def __grow(self):
+        """ Double the capacity of the arrays """
+        import numpy as np
+        for (k, a) in self.__arrays.items():
+            self.__arrays[k] = np.concatenate((a, np.zeros_like(a)))
+
+    def addColumn(self, name, dtype, fill=0):
+        """ Add a column to the store, set to fill for every new task """
+        import numpy as np
+        self.__arrays[name] = np.full(len(self.__arrays['cost']), fill, dtype=dtype)
+        self.__fills[name] = fill
+
+    def __checkId(self, check):
+        """ Get the id of a check, registering it on first use """
+        check_id = self.__checkIds.get(check)
+        if check_id is None:
+            if self.__freeChecks:
+                check_id = self.__freeChecks.pop()
+                self.__checks[check_id] = check
+            else:
+                check_id = len(self.__checks)
+                self.__checks.append(check)
+                self.__checkTasks.append(0)
+            self.__checkIds[check] = check_id
+        return check_id
+
+    def addTask(self, check, index, cost, time):
+        """ Store a new task of a check, returning its handle """
+        if self.__free:
+            slot = self.__free.pop()
+        else:
+            if self.__size == len(self.__arrays['cost']):
+                self.__grow()
+            slot = self.__size
+            self.__size += 1
+
+        a = self.__arrays
+        check_id = self.__checkId(check)
+        self.__checkTasks[check_id] += 1
+        a['cost'][slot] = cost
+        a['priority'][slot] = check.getPriority()
+        a['last'][slot] = time
+        a['check'][slot] = check_id
+        a['index'][slot] = index
+        a['state'][slot] = TaskStore.LIVE
+        for (k, fill) in self.__fills.items():
+            a[k][slot] = fill
+        return StoredTask(self, slot)
+
+    def releaseTasks(self, tasks):
+        """ Free the slots of tasks that are done with
+
+        The handles must not be used afterwards, their slots will be
+        given to new tasks.
+        """
+        for t in tasks:
+            slot = t.getSlot()
+            check_id = self.__arrays['check'][slot]
+            self.__arrays['state'][slot] = TaskStore.FREE
+            self.__free.append(slot)
+            self.__checkTasks[check_id] -= 1
+            if self.__checkTasks[check_id] == 0:
+                del self.__checkIds[self.__checks[check_id]]
+                self.__checks[check_id] = None
+                self.__freeChecks.append(check_id)
+
+    def getArrays(self):
+        """ Get the arrays of all the slots (they are replaced when the store grows) """
+        return self.__arrays
+
+    def getSlots(self, tasks):
+        """ Get the slots of a sequence of task handles as an array """
+        import numpy as np
+        return np.fromiter((t.getSlot() for t in tasks), dtype=np.int64, count=len(tasks))
+
+    def getTasks(self, slots):
+        """ Get the task handles of an array of slots """
+        return [StoredTask(self, s) for s in slots.tolist()]
+
+    def getLiveSlots(self):
+        """ Get the slots of all the tasks that haven't been released """
+        import numpy as np
+        return np.flatnonzero(self.__arrays['state'][:self.__size] == TaskStore.LIVE)
+
+    def getCheck(self, slot):
+        """ Get the check of a slot """
+        return self.__checks[self.__arrays['check'][slot]]
+
+    def getCheckId(self, check):
+        """ Get the id of a check in the check array (None if it has no tasks) """
+        return self.__checkIds.get(check)
+
+    def getSize(self):
+        """ Get the number of slots in use """
+        return self.__size - len(self.__free)
+
+class StoredTask:
+    """ Handle to a task in a TaskStore with the interface of Task
+
+    Any number of handles can refer to the same task, they compare and
+    hash by slot.
+    """
+    __slots__ = ('_store', '_slot')
+
+    def __init__(self, store, slot):
+        self._store = store
+        self._slot = slot
+
+    def __eq__(self, other):
+        return isinstance(other, StoredTask) and self._slot == other._slot and self._store is other._store
+
+    def __hash__(self):
+        return hash(self._slot)
+
+    def getSlot(self):
+        """ Get the slot of the task in its store """
+        return self._slot
+
+    def reset(self):
+        """ Reset the priority to it's initial value """
+        self._store.getArrays()['priority'][self._slot] = self.getCheck().getPriority()
+
+    def getCost(self):
+        """ Get the cost of the task """
+        return int(self._store.getArrays()['cost'][self._slot])
+
+    def getPriority(self):
+        """ Gets the priority of the task """
+        return int(self._store.getArrays()['priority'][self._slot])
+
+    def setPriority(self, p):
+        """ Set the priority of the task """
+        self._store.getArrays()['priority'][self._slot] = p
+
+    def getCheck(self):
+        """ Get the parent check """
+        return self._store.getCheck(self._slot)
+
+    def lastTimeRun(self):
+        """ Get the last time the task was run """
+        return int(self._store.getArrays()['last'][self._slot])
+
+    def run(self, time):
+        """ Notify the task that it has been run """
+        self._store.getArrays()['last'][self._slot] = time + self.getCost()
+
+    def __str__(self):
+        return "Task {}.{}".format(self.getCheck(), self._store.getArrays()['index'][self._slot])
+
+    def __repr__(self):
+        return self.__str__()
+
 class Bin:
     """ A bin is a collection of tasks that are going to run collectively """
     bin_count = 0 # Unique identifier for a bin
@@ -202,6 +400,10 @@ class Bin:
         """ Add a task to the bin """
         self.__tasks.append(t)
 
+    def addTasks(self, tasks):
+        """ Add several tasks to the bin """
+        self.__tasks.extend(tasks)
+
     def getTasks(self):
         """ Get the tasks from the bin """
         return self.__tasks
@@ -256,8 +458,8 @@ def getChecks():
 
 def schedulerOptions(parser):
     """ Add arguments to a parser that are the default settings for a scheduler """
-    binpackers = getBinPackers()
-    checksplitters = getCheckSplitters()
+    binpackers = registry.BINPACKERS.names()
+    checksplitters = registry.CHECKSPLITTERS.names()
 
     parser.add_argument('--task_granularity', dest='granularity', type=int,
                         default=50,  help='Max size of tasks (microseconds).')
@@ -269,12 +471,12 @@ def schedulerOptions(parser):
                         default=70,  help='Overhead of invoking SMM (microseconds).')
     parser.add_argument('sim_length', type=int,
                         help='Length of Simulation (seconds).')
-    parser.add_argument('--binpacker', choices=binpackers.keys(),
+    parser.add_argument('--binpacker', choices=binpackers,
                         default="DefaultBin",
                         help='The BinPacker class that wille be used to fill bins.')
     parser.add_argument('--cpus', type=int,
                         default=1,
                         help='Number of CPUs')
-    parser.add_argument('--checksplitter', choices=checksplitters.keys(),
+    parser.add_argument('--checksplitter', choices=checksplitters,
                         default="DefaultTasks",
                         help='The class that will convert checks into tasks.')
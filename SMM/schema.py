@@ -1,5 +1,4 @@
-from SMM import scheduler
-import jsonschema
+from SMM import registry
 
 """
 Contains the SCHEMA defined for the JSON communication protocol
@@ -12,188 +11,221 @@ relationship, there isn't a need to implement special validators
 in the simulator or worry about emitting invalid JSON.
 
 Read more about the format at http://json-schema.org/.
+
+The schema names the bin packers and check splitters that are
+available, so it's only built (and jsonschema imported) on first use.
 """
 
-SCHEMA = {
-    'oneOf': [
-        {'$ref':'#/action'},
-    ],
-    'action': {
-        'type':'object',
-        'properties':{
-            'action': {
-                'type':'string'
-            },
-            'time': {
-                'type':'integer',
-                'minimum': 0,
-            }
-        },
-        'required':[
-            'action',
-            'time'
-        ],
+_schema = None
+_validator = None
+
+def getSchema():
+    """ The SMM schema (built once) """
+    global _schema
+    if _schema is None:
+        _schema = buildSchema()
+    return _schema
+
+def __getattr__(name):
+    #SCHEMA is built when it's first accessed
+    if name == 'SCHEMA':
+        return getSchema()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def buildSchema():
+    """ Build the SMM schema with the registered bin packers and check splitters """
+    return {
         'oneOf': [
-            {'$ref': '#/actions/endsim'},
-            {'$ref': '#/actions/removecheck'},
-            {'$ref': '#/actions/newcheck'},
-            {'$ref': '#/actions/changevars'},
+            {'$ref':'#/action'},
         ],
-    },
-    'vars':{
-        'type':'object',
-        'properties': {
-            'taskgran':{
-                'type':'integer',
-                'minimum':1,
-            },
-            'smmpersecond':{
-                'type':'integer',
-                'minimum':1,
-            },
-            'smmoverhead':{
-                'type':'integer',
-                'minimum':0,
-            },
-            'binsize':{
-                'type':'integer',
-                'minimum': 1,
-            },
-            'cpus':{
-                'type':'integer',
-                'minimum':1,
-            },
-            'binpacker':{
-                'type':'string',
-                'enum':scheduler.getBinPackers().keys()
-            },
-            'checksplitter':{
-                'type':'string'
-            },
-            'rantask':{
-                'type':'string',
-                'enum':[
-                    'reschedule',
-                    'discard',
-                ],
-            },
-            'checksplitter':{
-                'type':'string',
-                'enum':scheduler.getCheckSplitters().keys()
-            }
-        },
-        'additionalProperties':False,
-    },
-    'check' : {
-        'type':'object',
-        'properties':{
-            'cost':{
-                'type':'integer',
-                'minimum':1,
-            },
-            'group':{
-                'type':'string'
-            },
-            'name':{
-                'type':'string',
-            },
-            'priority':{
-                'type':'integer',
-                'minimum':1,
-                'maximum':20,
-            },
-            'misc':{
-                'type':'object',
-            }
-        },
-        'additionalProperties':False,
-    },
-    'shortcheck':{
-        'type':'object',
-        'properties':{
-            'group':{
-                'type':'string'
-            },
-            'name':{
-                'type':'string',
-            },
-        },
-        'additionalProperties':False,
-    },
-    'actions': {
-        'endsim': {
+        'action': {
             'type':'object',
             'properties':{
-                'action':{
-                    'enum':['endsim']
+                'action': {
+                    'type':'string'
+                },
+                'time': {
+                    'type':'integer',
+                    'minimum': 0,
                 }
             },
             'required':[
-                'action'
-            ]
+                'action',
+                'time'
+            ],
+            'oneOf': [
+                {'$ref': '#/actions/endsim'},
+                {'$ref': '#/actions/removecheck'},
+                {'$ref': '#/actions/newcheck'},
+                {'$ref': '#/actions/changevars'},
+            ],
         },
-        'removecheck': {
+        'vars':{
             'type':'object',
-            'properties':{
-                'action':{
-                    'enum':['removecheck']
+            'properties': {
+                'taskgran':{
+                    'type':'integer',
+                    'minimum':1,
                 },
-                'checks':{
-                    'type':'array',
-                    'minitems':1,
-                    'items':{
-                        'type':'object',
-                        'oneOf':[{'$ref':'#/shortcheck'}],
-                    },
+                'smmpersecond':{
+                    'type':'integer',
+                    'minimum':1,
+                },
+                'smmoverhead':{
+                    'type':'integer',
+                    'minimum':0,
+                },
+                'binsize':{
+                    'type':'integer',
+                    'minimum': 1,
+                },
+                'cpus':{
+                    'type':'integer',
+                    'minimum':1,
+                },
+                'binpacker':{
+                    'type':'string',
+                    'enum':registry.BINPACKERS.names()
+                },
+                'checksplitter':{
+                    'type':'string'
+                },
+                'rantask':{
+                    'type':'string',
+                    'enum':[
+                        'reschedule',
+                        'discard',
+                    ],
+                },
+                'checksplitter':{
+                    'type':'string',
+                    'enum':registry.CHECKSPLITTERS.names()
                 }
             },
-            'required':[
-                'action',
-                'checks'
-            ]
+            'additionalProperties':False,
         },
-        'newcheck': {
+        'check' : {
             'type':'object',
             'properties':{
-                'action':{
-                    'enum':['newcheck']
+                'cost':{
+                    'type':'integer',
+                    'minimum':1,
                 },
-                'checks':{
-                    'type':'array',
-                    'minitems':1,
-                    'items':{
-                        'type':'object',
-                        'oneOf':[{'$ref':'#/check'}],
-                    },
+                'group':{
+                    'type':'string'
+                },
+                'name':{
+                    'type':'string',
+                },
+                'priority':{
+                    'type':'integer',
+                    'minimum':1,
+                    'maximum':20,
+                },
+                'misc':{
+                    'type':'object',
                 }
             },
-            'required':[
-                'action',
-                'checks',
-            ]
+            'additionalProperties':False,
         },
-        'changevars': {
+        'shortcheck':{
             'type':'object',
             'properties':{
-                'action':{
-                    'enum':['changevars']
+                'group':{
+                    'type':'string'
+                },
+                'name':{
+                    'type':'string',
                 },
-                'vars':{
-                    'type':'object',
-                    'oneOf':[{'$ref':'#/vars'}]
-                }
             },
-            'required':[
-                'action',
-                'vars',
-            ]
+            'additionalProperties':False,
+        },
+        'actions': {
+            'endsim': {
+                'type':'object',
+                'properties':{
+                    'action':{
+                        'enum':['endsim']
+                    }
+                },
+                'required':[
+                    'action'
+                ]
+            },
+            'removecheck': {
+                'type':'object',
+                'properties':{
+                    'action':{
+                        'enum':['removecheck']
+                    },
+                    'checks':{
+                        'type':'array',
+                        'minitems':1,
+                        'items':{
+                            'type':'object',
+                            'oneOf':[{'$ref':'#/shortcheck'}],
+                        },
+                    }
+                },
+                'required':[
+                    'action',
+                    'checks'
+                ]
+            },
+            'newcheck': {
+                'type':'object',
+                'properties':{
+                    'action':{
+                        'enum':['newcheck']
+                    },
+                    'checks':{
+                        'type':'array',
+                        'minitems':1,
+                        'items':{
+                            'type':'object',
+                            'oneOf':[{'$ref':'#/check'}],
+                        },
+                    }
+                },
+                'required':[
+                    'action',
+                    'checks',
+                ]
+            },
+            'changevars': {
+                'type':'object',
+                'properties':{
+                    'action':{
+                        'enum':['changevars']
+                    },
+                    'vars':{
+                        'type':'object',
+                        'oneOf':[{'$ref':'#/vars'}]
+                    }
+                },
+                'required':[
+                    'action',
+                    'vars',
+                ]
+            }
         }
     }
-}
 
 def validate(e):
     """ Validate a given dict against the SMM schema """
-    jsonschema.validate(e, SCHEMA)
+    global _validator
+    from jsonschema.exceptions import best_match
+    if _validator is None:
+        import jsonschema
+        #Check the schema and compile its validator once, not per event
+        s = getSchema()
+        cls = jsonschema.validators.validator_for(s)
+        cls.check_schema(s)
+        _validator = cls(s)
+    #The same error jsonschema.validate would raise
+    error = best_match(_validator.iter_errors(e))
+    if error is not None:
+        raise error
 
 def validatestream():
     """ Validates a stream against the SMM schema
@@ -202,22 +234,7 @@ def validatestream():
     """
     import sys
     import json
-    import functools
-    stream = sys.stdin
-    chunksize = 1024
-    read = functools.partial(stream.read, chunksize)
-    buffer = ""
-    decoder = json.JSONDecoder()
-    for chunk in iter(read, ''):
-        buffer += chunk
-        while buffer:
-            try:
-                buffer = buffer.lstrip()
-                obj, idx = decoder.raw_decode(buffer)
-                validate(obj)
-                print(json.dumps(obj))
-                buffer = buffer[idx:]
-            except ValueError as e:
-                break
-            except jsonschema.ValidationError as e:
-                raise
+    from SMM import jsonstream
+    for obj in jsonstream.iterWorkload(sys.stdin):
+        validate(obj)
+        print(json.dumps(obj, separators=(',', ':')))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+""" Workloads parsed once into arrays in shared memory
+
+A sweep runs the same workload with many scheduler configurations. The
+workload is parsed once into compact arrays (one row per event and one
+per check, with interned group and name strings) that are placed in a
+shared memory block. Integer costs and priorities are kept in arrays and
+any other fields of a check (e.g. misc) as JSON, so the events read back
+are the events of the workload. Every simulator process reads the events from the
+block without parsing JSON or copying the arrays.
+
+The block starts with the length of a JSON header describing the
+arrays (dtype, shape and offset) and a digest of their contents.
+"""
+
+import contextlib
+import hashlib
+import json
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from SMM import jsonstream
+
+VERSION = 2
+
+ACTIONS = ['newcheck', 'removecheck', 'changevars', 'endsim']
+
+#Fields of a check kept in arrays when they are integers, by bit of the fields mask
+FIELDS = ['cost', 'priority']
+
+#Number of events converted at a time when reading
+CHUNK_SIZE = 4096
+
+ALIGNMENT = 64
+
+def toArrays(events):
+    """ Convert a stream of events into arrays """
+    strings = {}
+    def intern(s):
+        return strings.setdefault(s, len(strings))
+    extras = {}
+    def internExtra(s):
+        return extras.setdefault(s, len(extras))
+
+    time = []
+    action = []
+    offsets = [0]
+    var_index = []
+    variables = []
+    group = []
+    name = []
+    columns = {f:[] for f in FIELDS}
+    fields = []
+    extra = []
+    for e in events:
+        time.append(e['time'])
+        action.append(ACTIONS.index(e['action']))
+        for c in e.get('checks', []):
+            group.append(intern(c['group']))
+            name.append(intern(c['name']))
+            rest = {k:v for (k, v) in c.items() if k not in ('group', 'name')}
+            mask = 0
+            for (bit, f) in enumerate(FIELDS):
+                if type(rest.get(f)) is int:
+                    columns[f].append(rest.pop(f))
+                    mask |= 1 << bit
+                else:
+                    columns[f].append(0)
+            fields.append(mask)
+            extra.append(internExtra(json.dumps(rest, sort_keys=True)) if rest else -1)
+        offsets.append(len(group))
+        if 'vars' in e:
+            var_index.append(len(variables))
+            variables.append(json.dumps(e['vars']))
+        else:
+            var_index.append(-1)
+
+    (string_blob, string_offsets) = packStrings(strings)
+    (vars_blob, vars_offsets) = packStrings(variables)
+    (extras_blob, extras_offsets) = packStrings(extras)
+    return {
+        'time':np.array(time, dtype=np.int64),
+        'action':np.array(action, dtype=np.int8),
+        'offsets':np.array(offsets, dtype=np.int64),
+        'var_index':np.array(var_index, dtype=np.int64),
+        'group':np.array(group, dtype=np.int32),
+        'name':np.array(name, dtype=np.int32),
+        'cost':np.array(columns['cost'], dtype=np.int64),
+        'priority':np.array(columns['priority'], dtype=np.int64),
+        'fields':np.array(fields, dtype=np.int8),
+        'extra':np.array(extra, dtype=np.int32),
+        'strings':string_blob,
+        'string_offsets':string_offsets,
+        'vars':vars_blob,
+        'vars_offsets':vars_offsets,
+        'extras':extras_blob,
+        'extras_offsets':extras_offsets,
+    }
+
+def packStrings(strings):
+    """ Pack strings (in order) into a UTF-8 blob and the offsets of each """
+    encoded = [s.encode() for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return (np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+def unpackStrings(blob, offsets):
+    """ Unpack the strings of packStrings """
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    return [data[a:b].decode() for (a, b) in zip(bounds[:-1], bounds[1:])]
+
+def digest(arrays):
+    """ Digest of the contents of the arrays """
+    h = hashlib.sha1()
+    for k in sorted(arrays):
+        h.update(k.encode())
+        h.update(np.ascontiguousarray(arrays[k]).tobytes())
+    return h.hexdigest()
+
+def create(locations, name=None):
+    """ Parse workloads (merged by time) into a new shared memory block
+
+    The caller owns the block and has to close and unlink it when done.
+    """
+    with contextlib.ExitStack() as stack:
+        streams = [jsonstream.iterWorkload(stack.enter_context(jsonstream.openWorkload(l))) for l in locations]
+        events = streams[0] if len(streams) == 1 else jsonstream.mergeWorkloads(streams)
+        arrays = toArrays(events)
+
+    layout = {}
+    offset = 0
+    for (k, a) in arrays.items():
+        layout[k] = {'dtype':a.dtype.str, 'shape':list(a.shape), 'offset':offset}
+        offset += -(-a.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'version':VERSION, 'digest':digest(arrays), 'arrays':layout}).encode()
+    start = -(-(8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(start + offset, 1))
+    shm.buf[:8] = len(header).to_bytes(8, 'little')
+    shm.buf[8:8 + len(header)] = header
+    for (k, a) in arrays.items():
+        view = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf, offset=start + layout[k]['offset'])
+        view[...] = a
+    return shm
+
+def attach(name):
+    """ Attach to a shared workload, returning the block, its header and array views
+
+    The block is left to its creator, attaching doesn't register it for
+    removal when this process exits.
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+    length = int.from_bytes(bytes(shm.buf[:8]), 'little')
+    header = json.loads(bytes(shm.buf[8:8 + length]).decode())
+    if header['version'] != VERSION:
+        raise ValueError("Shared workload {} has version {}, expected {}".format(name, header['version'], VERSION))
+    start = -(-(8 + length) // ALIGNMENT) * ALIGNMENT
+    arrays = {k:np.ndarray(l['shape'], dtype=l['dtype'], buffer=shm.buf, offset=start + l['offset'])
+              for (k, l) in header['arrays'].items()}
+    return (shm, header, arrays)
+
+def endTime(arrays):
+    """ Time of the endsim event ending a shared workload (None if there is none) """
+    if len(arrays['action']) and arrays['action'][-1] == ACTIONS.index('endsim'):
+        return int(arrays['time'][-1])
+    return None
+
+def checkFields(group, name, cost, priority, mask, extra):
+    """ Rebuild a check from its row in the arrays """
+    c = {'group':group, 'name':name}
+    if mask & 1:
+        c['cost'] = cost
+    if mask & 2:
+        c['priority'] = priority
+    if extra is not None:
+        c.update(extra)
+    return c
+
+def iterEvents(arrays):
+    """ Iterate over the events of a shared workload """
+    strings = unpackStrings(arrays['strings'], arrays['string_offsets'])
+    variables = unpackStrings(arrays['vars'], arrays['vars_offsets'])
+    #Decoded once, the extra fields of checks are shared between events
+    extras = [json.loads(x) for x in unpackStrings(arrays['extras'], arrays['extras_offsets'])]
+    for first in range(0, len(arrays['time']), CHUNK_SIZE):
+        last = min(first + CHUNK_SIZE, len(arrays['time']))
+        rows = slice(arrays['offsets'][first], arrays['offsets'][last])
+        base = arrays['offsets'][first]
+        offsets = (arrays['offsets'][first:last + 1] - base).tolist()
+        checks = list(zip(arrays['group'][rows].tolist(), arrays['name'][rows].tolist(),
+                          arrays['cost'][rows].tolist(), arrays['priority'][rows].tolist(),
+                          arrays['fields'][rows].tolist(), arrays['extra'][rows].tolist()))
+        for (i, (time, action, var_index)) in enumerate(zip(arrays['time'][first:last].tolist(),
+                                                           arrays['action'][first:last].tolist(),
+                                                           arrays['var_index'][first:last].tolist())):
+            e = {'time':time, 'action':ACTIONS[action]}
+            if action < 2:
+                e['checks'] = [checkFields(strings[g], strings[n], c, p, f, extras[x] if x >= 0 else None)
+                               for (g, n, c, p, f, x) in checks[offsets[i]:offsets[i + 1]]]
+            if var_index >= 0:
+                e['vars'] = json.loads(variables[var_index])
+            yield e
@@ -1,16 +1,33 @@
 #!/usr/bin/env python3
 
-from SMM.scheduler import CheckGroup, Check, Task, Bin, getChecks, getBinPackers, getCheckSplitters, get_git_revision_hash
-from SMM import binpackers, checksplitters, log, schema
+from SMM.scheduler import CheckGroup, Check, Task, TaskStore, Bin, getChecks, get_git_revision_hash
+from SMM import jsonstream, log, progress, registry
 import argparse
+import itertools
+import resource
 import sys
 import json
-from functools import partial
 import time as timelib
-import jsonschema
-import numpy as np
 
 
+#Scheduler variables until a workload changes them
+DEFAULT_VARS = {
+    'taskgran':50, #Task Granularity
+    'smmpersecond':10, #SMMs per second
+    'smmoverhead':70, #SMI Overhead
+    'binsize':100, # Bin Size
+    'binpacker':'DefaultBin', #Bin Packer
+    'cpus':1, #Number of CPUs
+    'checksplitter':'DefaultTasks', #Chosen CheckSplitter
+    'rantask':'reschedule', #What to do when task is complete
+}
+
+def peakMemory():
+    """ Peak resident set size of the process (bytes) """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
 class SchedulerState:
     """ Maintains the current state of the scheduler
 
@@ -20,21 +37,13 @@ class SchedulerState:
     not stored in local variables throughout the application.
     """
     def __init__(self, logger):
-        self.__state =  {
-            'taskgran':50, #Task Granularity
-            'smmpersecond':10, #SMMs per second
-            'smmoverhead':70, #SMI Overhead
-            'binsize':100, # Bin Size
-            'binpacker':'DefaultBin', #Bin Packer
-            'cpus':1, #Number of CPUs
-            'checksplitter':'DefaultTasks', #Chosen CheckSplitter
-            'rantask':'reschedule', #What to do when task is complete
-        }
+        self.__state = dict(DEFAULT_VARS)
         self.__checksplitter = None
         self.__binpacker = None
         self.__logger = logger
         self.__checks = {}
-        self.__tasks = []
+        #Number of tasks of every check that haven't been discarded or removed
+        self.__pending = {}
         self.__time = 0
         self.__done = False
 
@@ -51,7 +60,7 @@ class SchedulerState:
             self.__logger.addTask(time, task)
             self.__binpacker.addTask(task)
         elif self.getVar('rantask') == 'discard':
-            pass
+            self.__finishTasks([task])
         else:
             self.logger.error("Unknwon rantask setting")
 
@@ -83,20 +92,33 @@ class SchedulerState:
 
     def addCheck(self, group, new_check):
         """ Adds a check of the given name """
-        if group in self.__checks:
-            parent = self.__checks[group]
-        else:
-            parent = CheckGroup(group, [])
-            self.__checks[group] = parent
+        self.addChecks([(group, new_check)])
 
-        parent.addSubCheck(new_check)
-        new_tasks = self.__checksplitter.splitChecks(new_check, self.__state['taskgran'], self.getTime())
+    def addChecks(self, checks):
+        """ Adds a batch of (group name, check) pairs at the current time
 
-        self.__logger.timeEvent(self.__time, 0, "add_check", msg="Added {}".format(new_check))
+        The tasks of all the checks are logged and handed to the bin
+        packer at once.
+        """
+        new_tasks = []
+        for (group, new_check) in checks:
+            if group in self.__checks:
+                parent = self.__checks[group]
+            else:
+                parent = CheckGroup(group, [])
+                self.__checks[group] = parent
 
-        for t in new_tasks:
-            self.__logger.addTask(self.getTime(), t)
-            self.__binpacker.addTask(t)
+            parent.addSubCheck(new_check)
+            tasks = self.__checksplitter.splitChecks(new_check, self.__state['taskgran'], self.getTime())
+            self.__pending[new_check] = len(tasks)
+            if not tasks and self.getVar('rantask') == 'discard':
+                self.__releaseCheck(new_check)
+            new_tasks += tasks
+
+            self.__logger.timeEvent(self.__time, 0, "add_check", msg="Added {}".format(new_check))
+
+        self.__logger.addTasks(self.getTime(), new_tasks)
+        self.__binpacker.addTasks(new_tasks)
 
     def __updateVarState(self, k, v):
         """ Handle special cases for var changes like BinPacker, Checksplitter
@@ -105,14 +127,32 @@ class SchedulerState:
         like instantiating objects or other side effects.
         """
         if k == 'binpacker':
-            binpackers = getBinPackers()
             old = self.__binpacker
-            self.__binpacker = binpackers[v]()
+            self.__binpacker = registry.BINPACKERS.get(v)()
             if old is not None:
-                [self.__binpacker.addTask(x) for x in old.unusedTasks()]
+                self.__binpacker.addTasks(old.unusedTasks())
         elif k == 'checksplitter':
-            checksplitters = getCheckSplitters()
-            self.__checksplitter = checksplitters[v]()
+            self.__checksplitter = registry.CHECKSPLITTERS.get(v)()
+
+    def __releaseCheck(self, check):
+        """ Forget a check that has no tasks left, and its group once empty """
+        self.__pending.pop(check, None)
+        group = check.getGroup()
+        if group.getCheck(check.getName()) is check:
+            group.removeSubCheck(check.getName())
+        if group.isEmpty() and self.__checks.get(group.getName()) is group:
+            del self.__checks[group.getName()]
+
+    def __finishTasks(self, tasks):
+        """ Tasks are done for good, release them and any check left without tasks """
+        for t in tasks:
+            check = t.getCheck()
+            if check in self.__pending:
+                self.__pending[check] -= 1
+                if self.__pending[check] == 0:
+                    self.__releaseCheck(check)
+        if Check.taskStore is not None:
+            Check.taskStore.releaseTasks(tasks)
 
     def removeCheck(self, check):
         """ Removes a specified check """
@@ -120,7 +160,10 @@ class SchedulerState:
 
         subcheck = check.getGroup().removeSubCheck(check.getName())
         if subcheck:
-            self.__binpacker.removeSubCheck(subcheck)
+            removed = self.__binpacker.removeSubCheck(subcheck)
+            self.__logger.removeTasks(self.__time, removed)
+            self.__finishTasks(removed)
+            self.__releaseCheck(subcheck)
 
     def updateVar(self, k, v):
         """ Updates an internal variable state """
@@ -148,51 +191,39 @@ class SchedulerState:
         """ Get the current logger """
         return self.__logger
 
+    def getVars(self):
+        """ Gets all the current state vars """
+        return dict(self.__state)
+
     def getCheckGroups(self):
         """ Get the list of check groups """
         return self.__checks
 
 class RunWorkload:
-    """ Runs a given workload by interacting with the SimulatorState """
-    def __init__(self, state, stream, interactive, validate):
+    """ Runs a given workload by interacting with the SimulatorState
+
+    Several workloads are merged by time into one, including workloads
+    that are already parsed (e.g. from shared memory) given as events.
+    """
+    def __init__(self, state, streams, interactive, validate, prefix=False, events=None):
+        if validate:
+            import jsonschema
+            from SMM import schema
+
         def parse_json_stream(stream_name):
             """ Parses an incoming json stream workload """
-            if stream_name == '-':
-                stream = sys.stdin
-            else:
-                stream = open(stream_name)
-
-            if stream_name == '-' and interactive:
-                read = partial(stream.readline)
-            else:
-                chunksize = 1024
-                read = partial(stream.read, chunksize)
-            buffer = ""
-            decoder = json.JSONDecoder()
-            for chunk in iter(read, ''):
-                if interactive:
-                    buffer = chunk
-                else:
-                    buffer += chunk
-                while buffer:
+            stream = jsonstream.openWorkload(stream_name)
+            for obj in jsonstream.iterWorkload(stream, stream_name == '-' and interactive):
+                if validate:
                     try:
-                        buffer = buffer.lstrip()
-                        obj, idx = decoder.raw_decode(buffer)
-                        if validate:
-                            schema.validate(obj)
-                        yield obj
-                        buffer = buffer[idx:]
-                    except ValueError as e:
-                        if interactive:
-                            print(e)
-                        #Needs more input
-                        break
+                        schema.validate(obj)
                     except jsonschema.ValidationError as e:
                         if interactive:
                             print(e)
-                            break
+                            continue
                         else:
                             raise
+                yield obj
 
         self.__state = state
         #Set of possible commands from workload
@@ -202,14 +233,18 @@ class RunWorkload:
             'changevars':lambda msg : self.changeVars(msg['vars']),
             'endsim':lambda msg : self.__state.endSim(),
         }
-        self.__events = parse_json_stream(stream)
+        if isinstance(streams, str):
+            streams = [streams]
+        sources = [parse_json_stream(s) for s in streams] + list(events or [])
+        if len(sources) == 1:
+            self.__events = sources[0]
+        else:
+            self.__events = jsonstream.mergeWorkloads(sources, prefix)
         self.__nextEvent = None
 
     def createCheck(self, checks):
         """ Creates a set of checks in the simulator state """
-        for c in checks:
-            new = Check(c['name'], c['priority'], c['cost'])
-            self.__state.addCheck(c['group'], new)
+        self.__state.addChecks([(c['group'], Check(c['name'], c['priority'], c['cost'])) for c in checks])
 
     def removeCheck(self, checks):
         """ Removes a set of checks from the simulator state """
@@ -255,11 +290,14 @@ class RunWorkload:
 def main():
     parser = argparse.ArgumentParser(description='Simulate an SMM Scheduler')
 
-    parser.add_argument('workload', type=str,
-                        help='Specify the workload to run.')
+    parser.add_argument('workload', type=str, nargs='*',
+                        help='Specify the workload to run (several are merged by time).')
     parser.add_argument('--sqllog', type=str,
                         default="",
                         help='Desired Location of sqlite log (WILL OVERWRITE).')
+    parser.add_argument('--shard-seconds', type=float,
+                        default=None,
+                        help='Split the sqlite log into one database per window of simulated seconds.')
     parser.add_argument('--interactive',
                         default=False,
                         action='store_true',
@@ -272,21 +310,97 @@ def main():
                         default=False,
                         action='store_true',
                         help='Enable logging output.')
-
+    parser.add_argument('--log-format',
+                        default='text',
+                        choices=['text', 'json'],
+                        help='Format of the verbose log output (json is one object per line).')
+    parser.add_argument('--prefix-groups',
+                        default=False,
+                        action='store_true',
+                        help='Prefix the check groups of merged workloads by their index.')
+    parser.add_argument('--shm', type=str,
+                        default=None,
+                        help='Also run a workload parsed into shared memory (see SMM.sharedworkload).')
+    parser.add_argument('--task-store',
+                        default=False,
+                        action='store_true',
+                        help='Keep tasks in a columnar store (less memory, vectorized bin packers).')
+    parser.add_argument('--max-memory', type=float,
+                        default=None,
+                        help='Stop the simulation when its peak memory exceeds this (MiB).')
+    parser.add_argument('--progress', type=str,
+                        default=None,
+                        help='Report progress to stderr (-), a file or a file descriptor (fd:N) as JSON lines.')
+    parser.add_argument('--progress-interval', type=float,
+                        default=5.0,
+                        help='Wall time between progress reports (seconds).')
+    parser.add_argument('--profile', type=str,
+                        default=None,
+                        help='Write a cProfile of the run here, and collapsed stacks next to it (.folded).')
+    parser.add_argument('--profile-top', type=int,
+                        default=20,
+                        help='Number of the hottest functions recorded in the log.')
+    parser.add_argument('--cache-dir', type=str,
+                        default=None,
+                        help='Reuse the log of an identical earlier simulation from this cache (see SMM.cache).')
+    parser.add_argument('--cache-size', type=float,
+                        default=1024,
+                        help='Size of the cache, least recently used logs are evicted beyond it (MiB).')
 
     args = parser.parse_args()
 
+    if not args.workload and args.shm is None:
+        parser.error("a workload or --shm is required")
+    if args.cache_dir is not None and (args.sqllog == "" or args.shard_seconds or args.interactive or '-' in args.workload):
+        parser.error("--cache-dir needs --sqllog without --shard-seconds or --interactive, and workload files")
+
+    #Only import what the options need, to start quickly
+    if args.shm is not None:
+        from SMM import sharedworkload
+    if args.cache_dir is not None:
+        from SMM import cache
+    if args.profile is not None:
+        from SMM import profiling
+
+    shm_digest = None
+    if args.shm is not None:
+        (shm, header, arrays) = sharedworkload.attach(args.shm)
+        shm_digest = header['digest']
+
+    result_cache = None
+    if args.cache_dir is not None:
+        result_cache = cache.ResultCache(args.cache_dir, int(args.cache_size * 2**20))
+        cache_key = cache.simulationKey(args.workload, vars(args), shm_digest)
+        #Nothing is reused or stored for results that vary from run to run,
+        #and a profile needs the simulation to run
+        if cache_key is None:
+            result_cache = None
+        elif args.profile is None and result_cache.fetch(cache_key, args.sqllog):
+            cache.markHit(args.sqllog)
+            return
+
+    profiler = None
+    if args.profile is not None:
+        profiler = profiling.Profiler(args.profile)
+        profiler.start()
+
+    if args.task_store:
+        Check.setTaskStore(TaskStore())
+
     #Choose desired logger
     if args.sqllog != "":
-        logger = log.SqliteLog(args.verbose, args.sqllog)
+        shard_length = None
+        if args.shard_seconds:
+            shard_length = int(args.shard_seconds * 10**6)
+        logger = log.SqliteLog(args.verbose, args.sqllog, args.log_format, shard_length, Check.taskStore)
     else:
-        logger = log.SimLog(args.verbose)
+        logger = log.SimLog(args.verbose, args.log_format)
 
     # Collect system stats
     misc = {
         'start_gmt':timelib.strftime("%a, %d %b %Y %X +0000", timelib.gmtime()),
         'start_local':timelib.strftime("%a, %d %b %Y %X +0000"),
-        'start_cpu_clock':timelib.clock(),
+        'start_cpu_clock':timelib.process_time(),
         'start_wall_clock':timelib.time(),
         'ver':get_git_revision_hash(),
         'args': " ".join(map(lambda x : '"{}"'.format(x), sys.argv))
@@ -299,70 +413,118 @@ def main():
         logger.addMisc(k, v)
 
     #initiliaze system state and workload
+    events = []
+    ends = []
+    if args.shm is not None:
+        logger.addMisc('shm_digest', shm_digest)
+        events.append(sharedworkload.iterEvents(arrays))
+        ends.append(sharedworkload.endTime(arrays))
+
+    reporter = None
+    if args.progress is not None:
+        ends += [jsonstream.peekEndTime(w) for w in args.workload]
+        ends = [e for e in ends if e is not None]
+        reporter = progress.Progress(args.progress, args.progress_interval, max(ends) if ends else None)
+
     state = SchedulerState(logger)
-    workload = RunWorkload(state, args.workload, args.interactive, args.validate)
+    workload = RunWorkload(state, args.workload, args.interactive, args.validate, args.prefix_groups, events)
 
     #Run the actual simulation
-    workload.updateWorkload() #Updates all the time zero events
-    while state.simRunning():
-        workload.updateWorkload()
-        next_time = state.getTime() + one_second//state.getVar('smmpersecond')
-        bins = []
-        cpu_count = state.getVar('cpus')
-        # Collect bins to be run
-        for cpu_id in range(cpu_count):
-            bins.append(state.getPacker().requestBin(state, cpu_id))
-            logger.timeEvent(state.getTime(), state.getVar('smmoverhead'), "SMI", cpu=cpu_id)
-
-        state.moveTime(state.getVar('smmoverhead'))
-
-        #Determine ordering in tasks across bins
-        planned_tasks = []
-        for b, cpu_id in zip(bins, range(cpu_count)):
-            start_times = map(int, np.cumsum([0] + [t.getCost() for t in b.getTasks()]))
-            tasks = b.getTasks() + [None]
-            all_tasks = [(t, s, b, cpu_id) for (t,s) in zip(tasks, start_times)]
-            planned_tasks += all_tasks
-
-        planned_tasks = sorted(planned_tasks, key=lambda t : t[1])
-
-        #Start bins
-        for b, cpu_id in zip(bins, range(cpu_count)):
-            logger.timeEvent(state.getTime(), 0, "bin_start", cpu=cpu_id, bin=b)
-
-        #Run tasks within bins
-        time = state.getTime()
-        for (t, start_time, b, cpu_id) in planned_tasks:
-            state.moveTime(time + start_time - state.getTime())
-            if t is None:
-                logger.timeEvent(state.getTime(), 0, "bin_end", cpu=cpu_id, bin=b)
-            else:
-                logger.timeEvent(state.getTime(), t.getCost(), "run_task", task=t, cpu=cpu_id, bin=b)
-                t.run(state.getTime())
-                state.ranTask(state.getTime(), t)
+    exceeded = False
+    #Write out buffered lines even when the simulation fails
+    try:
+        workload.updateWorkload() #Updates all the time zero events
+        while state.simRunning():
+            if args.max_memory is not None and peakMemory() > args.max_memory * 2**20:
+                logger.error(state.getTime(), "Peak memory of {:.1f} MiB exceeds the limit of {:g} MiB".format(
+                    peakMemory() / 2**20, args.max_memory))
+                exceeded = True
+                break
+            logger.checkpoint(state.getTime())
+            if reporter is not None:
+                reporter.update(state)
+            workload.updateWorkload()
+            if args.interactive:
+                logger.flush()
+            next_time = state.getTime() + one_second//state.getVar('smmpersecond')
+            bins = []
+            cpu_count = state.getVar('cpus')
+            # Collect bins to be run
+            for cpu_id in range(cpu_count):
+                bins.append(state.getPacker().requestBin(state, cpu_id))
+                logger.timeEvent(state.getTime(), state.getVar('smmoverhead'), "SMI", cpu=cpu_id)
+
+            state.moveTime(state.getVar('smmoverhead'))
+
+            #Determine ordering in tasks across bins
+            planned_tasks = []
+            for b, cpu_id in zip(bins, range(cpu_count)):
+                start_times = itertools.accumulate([0] + [t.getCost() for t in b.getTasks()])
+                tasks = b.getTasks() + [None]
+                all_tasks = [(t, s, b, cpu_id) for (t,s) in zip(tasks, start_times)]
+                planned_tasks += all_tasks
+
+            planned_tasks = sorted(planned_tasks, key=lambda t : t[1])
+
+            #Start bins
+            for b, cpu_id in zip(bins, range(cpu_count)):
+                logger.timeEvent(state.getTime(), 0, "bin_start", cpu=cpu_id, bin=b)
+
+            #Run tasks within bins
+            time = state.getTime()
+            for (t, start_time, b, cpu_id) in planned_tasks:
+                state.moveTime(time + start_time - state.getTime())
+                if t is None:
+                    logger.timeEvent(state.getTime(), 0, "bin_end", cpu=cpu_id, bin=b)
+                else:
+                    logger.timeEvent(state.getTime(), t.getCost(), "run_task", task=t, cpu=cpu_id, bin=b)
+                    t.run(state.getTime())
+                    state.ranTask(state.getTime(), t)
 
-        #Assumes that overlapping bins will wait until previous bin finishes
-        if next_time > state.getTime():
-            state.moveTime(next_time - state.getTime())
-        else:
-            logger.warning(state.getTime(), "Current Bin Will not terminate before next Bin is scheduled")
+            #Assumes that overlapping bins will wait until previous bin finishes
+            if next_time > state.getTime():
+                state.moveTime(next_time - state.getTime())
+            else:
+                logger.warning(state.getTime(), "Current Bin Will not terminate before next Bin is scheduled")
+    finally:
+        logger.flush()
 
-    workload.updateWorkload() #Finish up any lingering events
+    if not exceeded:
+        workload.updateWorkload() #Finish up any lingering events
 
     logger.timeEvent(state.getTime(), 0, "end_sim")
+    if reporter is not None:
+        reporter.close(state)
 
     #Capture system state at the end of simulation
     misc = {
         'end_gmt':timelib.strftime("%a, %d %b %Y %X +0000", timelib.gmtime()),
         'end_local':timelib.strftime("%a, %d %b %Y %X +0000"),
-        'end_cpu_clock':timelib.clock(),
-        'end_wall_clock':timelib.time()
+        'end_cpu_clock':timelib.process_time(),
+        'end_wall_clock':timelib.time(),
+        'peak_rss':peakMemory(),
     }
+    if exceeded:
+        misc['max_memory_exceeded'] = state.getTime()
+    if result_cache is not None:
+        misc['cache_key'] = cache_key
+    if profiler is not None:
+        profiler.stop()
+        misc['profile_samples'] = profiler.getSamples()
+        misc['profile_top'] = json.dumps(profiler.getTop(args.profile_top))
+    #Record the final scheduler settings so runs can be told apart
+    misc.update(state.getVars())
 
     for k,v in misc.items():
         logger.addMisc(k, v)
 
     logger.endLog()
 
+    if result_cache is not None and not exceeded:
+        result_cache.store(cache_key, args.sqllog)
+
+    if exceeded:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+""" Streaming quantile sketches that can be merged across shards and runs """
+
+import math
+import numpy as np
+
+class QuantileSketch:
+    """ A sketch of a distribution with relative accuracy
+
+    Values are counted in logarithmically sized buckets (as in DDSketch),
+    so every quantile is estimated within the relative accuracy and
+    sketches from different shards or runs are merged by adding their
+    counts. Memory only grows with the logarithm of the range of values.
+    """
+    def __init__(self, accuracy=0.01):
+        self.__accuracy = accuracy
+        self.__gamma = (1 + accuracy) / (1 - accuracy)
+        self.__lngamma = math.log(self.__gamma)
+        self.__counts = {}
+        self.__zeros = 0
+        self.__count = 0
+
+    def buckets(self, values):
+        """ Get the bucket index of every (positive) value """
+        return np.ceil(np.log(values) / self.__lngamma).astype(np.int64)
+
+    def addCounts(self, buckets, counts):
+        """ Add counts to the given buckets """
+        for (b, c) in zip(buckets, counts):
+            b = int(b)
+            self.__counts[b] = self.__counts.get(b, 0) + int(c)
+            self.__count += int(c)
+
+    def addZeros(self, count):
+        """ Add values that are zero (or less) """
+        self.__zeros += int(count)
+        self.__count += int(count)
+
+    def add(self, values):
+        """ Add an array of values to the sketch """
+        values = np.asarray(values, dtype=float)
+        positive = values[values > 0]
+        self.addZeros(len(values) - len(positive))
+        self.addCounts(*np.unique(self.buckets(positive), return_counts=True))
+
+    def merge(self, other):
+        """ Add the values of another sketch of the same accuracy """
+        assert(self.__accuracy == other.getAccuracy())
+        data = other.getData()
+        self.addZeros(data['zeros'])
+        self.addCounts(map(int, data['counts'].keys()), data['counts'].values())
+        return self
+
+    def getAccuracy(self):
+        """ Get the relative accuracy of the sketch """
+        return self.__accuracy
+
+    def getCount(self):
+        """ Get the number of values in the sketch """
+        return self.__count
+
+    def quantile(self, q):
+        """ Estimate the value at quantile q (between 0 and 1) """
+        if self.__count == 0:
+            return 0.0
+
+        rank = q * (self.__count - 1)
+        seen = self.__zeros
+        if seen > rank:
+            return 0.0
+
+        for b in sorted(self.__counts):
+            seen += self.__counts[b]
+            if seen > rank:
+                return 2 * self.__gamma ** b / (self.__gamma + 1)
+
+        return 2 * self.__gamma ** max(self.__counts) / (self.__gamma + 1)
+
+    def getData(self):
+        """ JSON formatted version of the sketch """
+        return {
+            'accuracy':self.__accuracy,
+            'zeros':self.__zeros,
+            'counts':{str(b):c for (b, c) in self.__counts.items()},
+        }
+
+def fromData(data):
+    """ Create a sketch from its JSON formatted version """
+    s = QuantileSketch(data['accuracy'])
+    s.addZeros(data['zeros'])
+    s.addCounts(map(int, data['counts'].keys()), data['counts'].values())
+    return s
+
+def groupedSketches(groups, values, accuracy=0.01):
+    """ Build one sketch per group of values in a single pass
+
+    The bucket of each value is computed once and the (group, bucket)
+    pairs are counted together.
+    """
+    groups = np.asarray(groups)
+    values = np.asarray(values, dtype=float)
+    sketches = {g:QuantileSketch(accuracy) for g in np.unique(groups).tolist()}
+    if len(values) == 0:
+        return sketches
+
+    positive = values > 0
+    (zgroups, zcounts) = np.unique(groups[~positive], return_counts=True)
+    for (g, c) in zip(zgroups.tolist(), zcounts):
+        sketches[g].addZeros(c)
+
+    index = np.unique(groups, return_inverse=True)[1].reshape(-1)
+    pairs = np.stack((index[positive], QuantileSketch(accuracy).buckets(values[positive])))
+    (pairs, counts) = np.unique(pairs, axis=1, return_counts=True)
+    keys = list(sketches.keys())
+    for g in np.unique(pairs[0]):
+        mask = pairs[0] == g
+        sketches[keys[g]].addCounts(pairs[1][mask], counts[mask])
+    return sketches
+
+def percentiles(sketch, quantiles=(0.5, 0.9, 0.99, 0.999)):
+    """ Summarize a sketch by a set of percentiles """
+    p = {"p{:g}".format(q * 100):sketch.quantile(q) for q in quantiles}
+    p['count'] = sketch.getCount()
+    return p
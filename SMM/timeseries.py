@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+""" Windowed time series of a simulation run
+
+Where the benchmarks summarize a whole run, the time series shows how
+the scheduler behaved in every window of simulated time, e.g. when it
+fell behind. It is computed with a single streaming pass over the events.
+"""
+
+import os
+import re
+import sqlite3
+import numpy as np
+from SMM import log, sketch
+
+#Bin size used by the simulator until a workload changes it
+DEFAULT_BINSIZE = 100
+#Number of events read from the log at a time
+CHUNK_SIZE = 65536
+
+BINSIZE_CHANGE = re.compile(r"Changed Var binsize to (\d+)")
+
+class TimeSeries:
+    """ Per window counters and response time sketches of a run """
+    def __init__(self, window):
+        self.__window = window
+        self.__series = {}
+        self.__sketches = {}
+
+    def getWindow(self):
+        """ Get the window length (microseconds) """
+        return self.__window
+
+    def add(self, name, windows, weights=None):
+        """ Add the (weighted) counts of events in the given windows to a series """
+        if len(windows) == 0:
+            return
+        counts = np.bincount(windows, weights=weights)
+        series = self.__series.get(name, np.zeros(0))
+        if len(counts) > len(series):
+            series = np.pad(series, (0, len(counts) - len(series)))
+        series[:len(counts)] += counts
+        self.__series[name] = series
+
+    def addResponses(self, windows, responses):
+        """ Add response times to the sketches of their windows """
+        self.addSketches(sketch.groupedSketches(windows, responses))
+
+    def merge(self, other):
+        """ Merge the time series of another part of the same run (e.g. a shard) """
+        for (name, series) in other.getSeries().items():
+            self.add(name, np.arange(len(series)), series)
+        self.addSketches(other.getSketches())
+        return self
+
+    def addSketches(self, sketches):
+        """ Merge in response time sketches by window """
+        for (w, s) in sketches.items():
+            if w in self.__sketches:
+                self.__sketches[w].merge(s)
+            else:
+                self.__sketches[w] = s
+
+    def getSeries(self):
+        """ Get the raw series by name """
+        return self.__series
+
+    def getSketches(self):
+        """ Get the response time sketches by window """
+        return self.__sketches
+
+    def getArrays(self):
+        """ Get the per window metrics as arrays of equal length """
+        length = max([len(s) for s in self.__series.values()] + [max(self.__sketches, default=-1) + 1])
+        def series(name):
+            s = self.__series.get(name, np.zeros(0))
+            return np.pad(s, (0, length - len(s)))
+
+        cpus = sorted(int(name[len('smm_time_cpu'):]) for name in self.__series if name.startswith('smm_time_cpu'))
+        capacity = series('capacity')
+        filled = series('bin_time')
+        fill = np.divide(filled, capacity, out=np.zeros(length), where=capacity > 0)
+
+        percentiles = np.zeros((3, length))
+        for (w, s) in self.__sketches.items():
+            percentiles[:, w] = [s.quantile(q) for q in (0.5, 0.99, 0.999)]
+
+        return {
+            'window_start':np.arange(length, dtype=np.int64) * self.__window,
+            'queue_depth':np.cumsum(series('added') - series('removed')).astype(np.int64),
+            'tasks_run':series('tasks_run').astype(np.int64),
+            'bin_fill':fill,
+            'response_p50':percentiles[0],
+            'response_p99':percentiles[1],
+            'response_p999':percentiles[2],
+            'smm_share':np.stack([series('smm_time_cpu{}'.format(c)) / self.__window for c in cpus], axis=1)
+                        if cpus else np.zeros((length, 0)),
+        }
+
+def collect(db, window, binsize=DEFAULT_BINSIZE):
+    """ Compute the time series of a single database in one pass over its events
+
+    Returns the time series and the bin size in effect at the end, to
+    carry over to the next shard.
+    """
+    ts = TimeSeries(window)
+    conn = sqlite3.connect(db)
+    types = dict(conn.execute("SELECT name, id FROM event_type").fetchall())
+    def typeid(name):
+        return types.get(name, -1)
+
+    (add, rm, run, smi, start, varchange) = map(typeid, ['add_task', 'rm_task', 'run_task', 'SMI', 'bin_start', 'varchange'])
+
+    c = conn.execute("""
+    select event.time, event.type_id, event.cpu_id, event.length, job.add_time,
+           case when event.type_id = ? then event.msg end
+    from event
+    left join job on job.id = event.job_id and event.type_id = ?
+    order by event.id""", (varchange, run))
+
+    while True:
+        rows = c.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+
+        (time, type_id, cpu, length, add_time, msg) = zip(*rows)
+        time = np.array(time, dtype=np.int64)
+        type_id = np.array(type_id)
+        cpu = np.nan_to_num(np.array(cpu, dtype=float), nan=-1).astype(np.int64)
+        length = np.nan_to_num(np.array(length, dtype=float))
+        add_time = np.array(add_time, dtype=float)
+        windows = time // window
+
+        ts.add('added', windows[type_id == add])
+        ts.add('removed', windows[type_id == rm])
+
+        ran = type_id == run
+        ts.add('tasks_run', windows[ran])
+        ts.add('bin_time', windows[ran], length[ran])
+        finished = ran & ~np.isnan(add_time)
+        ts.addResponses(windows[finished], time[finished] - add_time[finished])
+
+        #Capacity of the bins started, tracking the bin size through var changes
+        starts = np.flatnonzero(type_id == start)
+        changes = [(i, int(m.group(1))) for i in np.flatnonzero(type_id == varchange)
+                   for m in [BINSIZE_CHANGE.match(msg[i] or "")] if m]
+        sizes = np.full(len(starts), binsize, dtype=float)
+        for (i, size) in changes:
+            sizes[starts > i] = size
+            binsize = size
+        ts.add('capacity', windows[starts], sizes)
+
+        smm = ran | (type_id == smi)
+        for c_id in np.unique(cpu[smm & (cpu >= 0)]):
+            mask = smm & (cpu == c_id)
+            ts.add('smm_time_cpu{}'.format(c_id), windows[mask], length[mask])
+
+    conn.close()
+    return (ts, binsize)
+
+def timeseries(db, window):
+    """ Compute the time series of a run from its log (all shards of it, in order) """
+    ts = TimeSeries(window)
+    binsize = DEFAULT_BINSIZE
+    for path in log.shardFiles(db) or [db]:
+        if os.path.exists(path):
+            (part, binsize) = collect(path, window, binsize)
+            ts.merge(part)
+    return ts
+
+def save(location, ts):
+    """ Store the time series as a compressed NumPy archive """
+    arrays = ts.getArrays()
+    np.savez_compressed(location, window=np.int64(ts.getWindow()), **arrays)
@@ -1,22 +1,88 @@
 #!/usr/bin/env python3
 
-from SMM import scheduler, schema
+from SMM import jsonstream, scheduler, schema
+import io
 import json
 import argparse
 import numpy as np
 import random
 import os
+import sys
+from multiprocessing import Pool
 
 """ The workload module is a useful entry point for
 creating various JSON workloads for the SMM Simulator
 """
 
 class Workload:
-    """ A useful generator class to create a JSON workload """
-    def __init__(self, validate):
-        self.__events = []
+    """ A useful generator class to create a JSON workload
+
+    Events are written to the sink (a location or a file object) as they
+    are created, one compact JSON object per line unless pretty printed.
+    Locations ending in .gz or .xz are compressed. Consecutive new (or
+    removed) checks at the same time are written as a single event.
+    """
+    def __init__(self, sink, validate=False, pretty=False):
+        if isinstance(sink, str):
+            self.__sink = jsonstream.openWorkload(sink, 'w')
+            self.__owned = sink != '-'
+        else:
+            self.__sink = sink
+            self.__owned = False
         self.__time = 0
         self.__validate = validate
+        if pretty:
+            self.__encode = json.JSONEncoder(indent=4).encode
+        else:
+            self.__encode = json.JSONEncoder(separators=(',', ':')).encode
+        self.__compact = not (pretty or validate)
+        self.__pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __write(self, e):
+        """ Write a single event to the sink """
+        self.__flush()
+        self.__writeEvent(e)
+
+    def __writeEvent(self, e):
+        """ Validate and encode an event """
+        if self.__validate:
+            schema.validate(e)
+        self.__sink.write(self.__encode(e) + "\n")
+
+    def __queue(self, time, action, checks):
+        """ Queue checks for an event, coalescing consecutive events of the same time and action
+
+        In compact mode the checks are already encoded.
+        """
+        if self.__pending is not None and self.__pending[:2] == (time, action):
+            self.__pending[2].extend(checks)
+        else:
+            self.__flush()
+            self.__pending = (time, action, list(checks))
+
+    def __flush(self):
+        """ Write out the queued check event """
+        if self.__pending is None:
+            return
+
+        (time, action, checks) = self.__pending
+        self.__pending = None
+        if self.__compact:
+            self.__sink.write('{{"time":{},"action":"{}","checks":[{}]}}\n'.format(time, action, ','.join(checks)))
+        else:
+            self.__writeEvent(
+                {
+                    'time':time,
+                    'action':action,
+                    'checks':checks,
+                }
+            )
 
     def timeForward(self, n):
         """ Only move time forward """
@@ -29,27 +95,45 @@ class Workload:
 
     def createCheck(self, c):
         """Create a check in the workload """
-        self.__events.append(
-            {
-                'time':self.__time,
-                'action':'newcheck',
-                'checks':c.getData()
-            }
-        )
+        checks = c.getData()
+        if self.__compact:
+            checks = map(self.__encode, checks)
+        self.__queue(self.__time, 'newcheck', checks)
+
+    def createCheckArrays(self, times, costs, priorities, first_id, prefix='random_'):
+        """ Create checks of a single subcheck each from arrays
+
+        The checks are numbered from first_id and created at the given
+        times, which may not be before the current time. The time is not
+        moved, the caller moves it forward past the checks.
+        """
+        assert(len(times) == 0 or times[0] >= self.__time)
+        times = np.asarray(times)
+        rows = zip(range(first_id, first_id + len(times)), np.asarray(costs).tolist(), np.asarray(priorities).tolist())
+        if self.__compact:
+            #Format the checks directly, the same as the encoder would
+            check = '{{"group":"%s{0}","name":"{0}","cost":{1},"priority":{2},"misc":{{}}}}' % json.dumps(prefix)[1:-1]
+            checks = [check.format(*r) for r in rows]
+        else:
+            checks = [{'group':prefix + str(i), 'name':str(i), 'cost':cost, 'priority':priority, 'misc':{}}
+                      for (i, cost, priority) in rows]
+
+        #One event per distinct time
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(times)) + 1, [len(times)])).tolist()
+        for (a, b) in zip(bounds[:-1], bounds[1:]):
+            if a < b:
+                self.__queue(int(times[a]), 'newcheck', checks[a:b])
 
     def removeCheck(self, c):
         """ Remove an check from the workload """
-        self.__events.append(
-            {
-                'time':self.__time,
-                'action':'removecheck',
-                'checks':list(map(lambda c : {'name':c['name'], 'group':c['group']}, c.getData()))
-            }
-        )
+        checks = list(map(lambda c : {'name':c['name'], 'group':c['group']}, c.getData()))
+        if self.__compact:
+            checks = map(self.__encode, checks)
+        self.__queue(self.__time, 'removecheck', checks)
 
     def endSim(self):
         """ End the simulation """
-        self.__events.append(
+        self.__write(
             {
                 'time':self.__time,
                 'action':'endsim',
@@ -58,7 +142,7 @@ class Workload:
 
     def changeVars(self, vars):
         """ Modify the simulator state variables """
-        self.__events.append(
+        self.__write(
             {
                 'time':self.__time,
                 'action':'changevars',
@@ -66,77 +150,263 @@ class Workload:
             }
         )
 
-    def writeWorkload(self, file_path):
-        """ Write the workload to a file """
-        with open(file_path, 'w') as f:
-            for e in self.__events:
-                if self.__validate:
-                    schema.validate(e)
-                f.write(json.dumps(e, indent=4) + "\n")
-
-def loadFactor(w, args):
-    check_count = 0
-    smm_count = 1
-    total = 0
+    def addEvent(self, e):
+        """ Add an event as it is (e.g. read from another workload), moving to its time """
+        assert(e['time'] >= self.__time)
+        self.__time = e['time']
+        if e['action'] in ('newcheck', 'removecheck'):
+            checks = e['checks']
+            if self.__compact:
+                checks = map(self.__encode, checks)
+            self.__queue(self.__time, e['action'], checks)
+        else:
+            self.__write(e)
+
+    def writeEvents(self, text):
+        """ Append events already written by another workload (e.g. a shard)
+
+        The events must not be before the current time, the caller moves
+        the time forward past them.
+        """
+        self.__flush()
+        self.__sink.write(text)
+
+    def close(self):
+        """ Finish writing the workload """
+        self.__flush()
+        if self.__owned:
+            self.__sink.close()
+        else:
+            self.__sink.flush()
+
+def randomChecks(args, size, rng=np.random):
+    """ Draw the costs and priorities of a batch of random checks
+
+    Costs are normal, or heavy tailed Pareto with a mean of cost_mu.
+    """
+    if args.cost_dist == 'pareto':
+        scale = args.cost_mu * (args.cost_alpha - 1) / args.cost_alpha
+        cost = scale * (1 + rng.pareto(args.cost_alpha, size))
+    else:
+        cost = rng.normal(args.cost_mu, args.cost_sigma, size)
+    cost = np.clip(cost, 1, args.cost_max).astype(np.int64)
+    priority = rng.normal(args.priority_mu, args.priority_sigma, size)
+    priority = np.clip(priority, 1, 20).astype(np.int64)
+    return (cost, priority)
+
+def loadPeriod(args):
+    """ Get the length of an SMM period and of its metering iterations """
     one_second = 10 ** 6
-    next_time = w.getTime() + one_second // args.smm_per_sec
     iteration_count = 10
-    iteration = (next_time - w.getTime()) / iteration_count
-
-    total_bin_time = lambda  : (args.cpus * smm_count * args.bin_size)
-
-    endtime = args.sim_length * 10**6
-    #Try to meter out the checks over the simulation runtime to meet
-    # the workload factor criteria
-    while w.getTime() < endtime:
-        for i in range(iteration_count):
-            rand_size = 10000
-            if check_count % rand_size == 0:
-                cost = np.random.normal(args.cost_mu, args.cost_sigma, rand_size)
-                cost = np.clip(cost, 1, 1000)
-                priority = np.random.normal(args.priority_mu, args.priority_sigma, rand_size)
-                priority = np.clip(priority, 1, 20)
-
-            while total / total_bin_time() - args.load < - 0.1 * (iteration_count - 1 - i):
-                cg = scheduler.CheckGroup('random_' + str(check_count))
-                c = scheduler.Check(str(check_count), int(priority[check_count % rand_size]), int(cost[check_count % rand_size]))
-                check_count += 1
-                total += c.getCost()
-                cg.addSubCheck(c)
-                w.createCheck(cg)
-
-            w.timeForward(iteration)
-
-        smm_count += 1
-
-    if endtime < w.getTime():
-        w.moveTimeForward(endtime - w.getTime())
-
-def uniformChecks(w, args):
-    one_second = 10**6
-    endtime = args.sim_length * one_second
-    timestep = int(one_second / args.checks_per_sec)
+    iteration = max(int((one_second // args.smm_per_sec) / iteration_count), 1)
+    return (iteration * iteration_count, iteration)
+
+def loadFactor(w, args, endtime=None, rng=np.random, prefix='random_'):
+    """ Meter out random checks over the simulation to meet the load factor
+
+    Every SMM period is split into iterations, by the end of iteration
+    i of period n the total cost of the checks reaches the fraction
+    (load - 0.1 * (iterations - 1 - i)) of the bin time of n periods.
+    The checks of a window of periods are placed at once by searching
+    the cumulative costs for the thresholds of each iteration.
+
+    Generation may start at any period (e.g. for a shard), the checks
+    before it are assumed to have met the load exactly.
+    """
+    (period, iteration) = loadPeriod(args)
+    iteration_count = period // iteration
+    if endtime is None:
+        endtime = args.sim_length * 10 ** 6
+    assert(w.getTime() % period == 0)
+    done = w.getTime() // period
+    periods = -(-(endtime - w.getTime()) // period)
+
+    rand_size = 10000
+    window = max(rand_size // iteration_count, 1)
+    cost = np.zeros(0, dtype=np.int64)
+    priority = np.zeros(0, dtype=np.int64)
+    check_count = 0
+    total = args.cpus * args.bin_size * done * args.load
+    #Highest threshold so far, the checks can't be taken back
+    reached = total
+    for first in range(0, max(periods, 0), window):
+        n = min(window, periods - first)
+        smm_count = np.repeat(np.arange(done + first + 1, done + first + n + 1), iteration_count)
+        i = np.tile(np.arange(iteration_count), n)
+        thresholds = args.cpus * args.bin_size * smm_count * (args.load - 0.1 * (iteration_count - 1 - i))
+        thresholds = np.maximum.accumulate(np.maximum(thresholds, reached))
+        reached = thresholds[-1]
+
+        #Draw until the checks cover the window
+        while total + cost.sum() < reached:
+            (c, p) = randomChecks(args, rand_size, rng)
+            cost = np.concatenate((cost, c))
+            priority = np.concatenate((priority, p))
+
+        #Checks are added while the total is below the threshold of the iteration
+        cumulative = total + np.concatenate(([0], np.cumsum(cost)))
+        added = np.searchsorted(cumulative, thresholds, 'left')
+        counts = np.diff(np.concatenate(([0], added)))
+        times = w.getTime() + np.arange(len(thresholds), dtype=np.int64) * iteration
+
+        count = added[-1]
+        w.createCheckArrays(np.repeat(times, counts), cost[:count], priority[:count], check_count, prefix)
+        check_count += count
+        total = cumulative[count]
+        cost = cost[count:]
+        priority = priority[count:]
+        w.timeForward(n * period)
+
+def uniformStep(args):
+    """ Get the time between two checks of a fixed rate """
+    timestep = int(10**6 / args.checks_per_sec)
     if timestep <= 0:
         timestep = 1
-    check_count = 0
-    while w.getTime() < endtime:
-        rand_size = 10000
-        if check_count % rand_size == 0:
-            cost = np.random.normal(args.cost_mu, args.cost_sigma, rand_size)
-            cost = np.clip(cost, 1, 1000)
-            priority = np.random.normal(args.priority_mu, args.priority_sigma, rand_size)
-            priority = np.clip(priority, 1, 20)
-
-        cg = scheduler.CheckGroup('random_' + str(check_count))
-        c = scheduler.Check(
-            str(check_count),
-            int(priority[check_count % rand_size]),
-            int(cost[check_count % rand_size])
-        )
-        check_count += 1
-        cg.addSubCheck(c)
-        w.createCheck(cg)
-        w.timeForward(timestep)
+    return timestep
+
+def uniformChecks(w, args, endtime=None, rng=np.random, prefix='random_'):
+    """ Create random checks at a fixed rate """
+    timestep = uniformStep(args)
+    if endtime is None:
+        endtime = args.sim_length * 10**6
+    assert(w.getTime() % timestep == 0)
+    count = max(-(-(endtime - w.getTime()) // timestep), 0)
+
+    rand_size = 10000
+    for first in range(0, count, rand_size):
+        n = min(rand_size, count - first)
+        (cost, priority) = randomChecks(args, rand_size, rng)
+        times = w.getTime() + np.arange(n, dtype=np.int64) * timestep
+        w.createCheckArrays(times, cost[:n], priority[:n], first, prefix)
+        w.timeForward(n * timestep)
+
+def arrivalRate(args):
+    """ Mean checks per second of the arrival processes
+
+    With --load the rate that offers the load on average, from the mean
+    cost of a large sample of checks (drawn from a separate generator).
+    """
+    if args.checks_per_sec is not None:
+        return args.checks_per_sec
+    mean_cost = randomChecks(args, 100000, np.random.default_rng(0))[0].mean()
+    return args.load * args.cpus * args.bin_size * args.smm_per_sec / mean_cost
+
+def poissonTimes(rng, start, end, rate):
+    """ Arrival times of a Poisson process (per second rate) between two times
+
+    Given their number, Poisson arrivals are uniformly distributed, so
+    every window of about a batch of arrivals is drawn at once.
+    """
+    window = max(int(10000 / rate * 10**6), 1) if rate > 0 else end - start
+    for first in range(start, end, window):
+        last = min(first + window, end)
+        n = rng.poisson(rate * (last - first) / 10**6)
+        yield np.sort(rng.integers(first, last, n))
+
+def poissonArrivals(args, start, end, rng):
+    """ Arrival times of checks at exponentially distributed intervals """
+    yield from poissonTimes(rng, start, end, arrivalRate(args))
+
+def mmppArrivals(args, start, end, rng):
+    """ Arrival times of a two state Markov modulated Poisson process
+
+    The process alternates between calm and burst periods of exponential
+    lengths, bursts arrive burst_factor times faster. The rates are set
+    so the average rate is the requested one. The state at the start is
+    drawn from the long run fraction of time in bursts.
+    """
+    lengths = (args.calm_seconds * 10**6, args.burst_seconds * 10**6)
+    calm = arrivalRate(args) * sum(lengths) / (lengths[0] + args.burst_factor * lengths[1])
+    rates = (calm, calm * args.burst_factor)
+    state = int(rng.random() < lengths[1] / sum(lengths))
+    time = start
+    while time < end:
+        last = min(end, time + max(int(rng.exponential(lengths[state])), 1))
+        yield from poissonTimes(rng, time, last, rates[state])
+        (time, state) = (last, 1 - state)
+
+ARRIVALS = {
+    'poisson':poissonArrivals,
+    'mmpp':mmppArrivals,
+}
+
+def arrivalChecks(w, args, endtime=None, rng=np.random, prefix='random_'):
+    """ Create random checks at the times of an arrival process """
+    if endtime is None:
+        endtime = args.sim_length * 10**6
+    first = 0
+    for times in ARRIVALS[args.arrival](args, w.getTime(), endtime, rng):
+        (cost, priority) = randomChecks(args, len(times), rng)
+        w.createCheckArrays(times, cost, priority, first, prefix)
+        first += len(times)
+    w.timeForward(endtime - w.getTime())
+
+def traceChecks(w, location, speedup=1.0, endtime=0, prefix='trace_'):
+    """ Replay checks recorded in a CSV file
+
+    The file has a header and columns time (microseconds), cost and
+    priority. Arrivals are sorted by time and the times divided by the
+    speedup, e.g. to replay a trace as overload. The workload runs until
+    the end time or the last arrival.
+    """
+    with open(location) as f:
+        header = [h.strip() for h in f.readline().split(',')]
+        columns = [header.index(c) for c in ('time', 'cost', 'priority')]
+        data = np.loadtxt(f, delimiter=',', usecols=columns, ndmin=2, dtype=float)
+
+    (times, cost, priority) = data[np.argsort(data[:, 0], kind='stable')].T
+    times = (times / speedup).astype(np.int64)
+    assert(len(times) == 0 or times[0] >= w.getTime())
+    w.createCheckArrays(times, cost.astype(np.int64), priority.astype(np.int64), 0, prefix)
+    w.timeForward(max([endtime] + times[-1:].tolist()) - w.getTime())
+
+def randomGenerator(args):
+    """ Get the generator of random checks chosen by the arguments """
+    if args.arrival != 'fixed':
+        return arrivalChecks
+    elif args.load is not None:
+        return loadFactor
+    else:
+        return uniformChecks
+
+def randomShard(shard):
+    """ Generate the checks of one time range of a random workload
+
+    Returns the written events and the time at the end of the shard.
+    """
+    (args, start, end, seed, prefix) = shard
+    sink = io.StringIO()
+    w = Workload(sink, args.validate, args.pretty)
+    w.timeForward(start)
+    randomGenerator(args)(w, args, end, np.random.default_rng(seed), prefix)
+    w.close()
+    return (sink.getvalue(), w.getTime())
+
+def randomShards(w, args):
+    """ Generate random checks in time shards on a process pool
+
+    Every shard has its own seed spawned from the main seed, so the
+    workload only depends on the seed and the shard length. Check groups
+    are prefixed by the shard to keep them unique. Shards are written in
+    time order as they finish.
+    """
+    if args.arrival != 'fixed':
+        step = 1
+    elif args.load is not None:
+        step = loadPeriod(args)[0]
+    else:
+        step = uniformStep(args)
+    endtime = args.sim_length * 10**6
+    length = max(-(-int(args.shard_seconds * 10**6) // step), 1) * step
+    starts = range(0, endtime, length)
+    seeds = np.random.SeedSequence(args.seed).spawn(len(starts))
+    shards = [(args, start, min(start + length, endtime), seed, 'random_{}_'.format(i))
+              for (i, (start, seed)) in enumerate(zip(starts, seeds))]
+
+    with Pool(args.jobs) as p:
+        for (text, end) in p.imap(randomShard, shards):
+            w.writeEvents(text)
+            w.timeForward(end - w.getTime())
 
 def randWorkload():
     """ Generate a random workload based on random criteria """
@@ -147,6 +417,12 @@ def randWorkload():
                         help='Cost Mean')
     parser.add_argument('--cost-sigma', type=float, default=1,
                         help='Priority Sigma')
+    parser.add_argument('--cost-dist', choices=['normal', 'pareto'], default='normal',
+                        help='Distribution of the check costs (pareto is heavy tailed with mean COST_MU).')
+    parser.add_argument('--cost-alpha', type=float, default=1.5,
+                        help='Shape of the Pareto costs (smaller is heavier, must be > 1).')
+    parser.add_argument('--cost-max', type=int, default=1000,
+                        help='Largest check cost.')
 
     parser.add_argument('--priority-mu', type=int, default=10,
                         help='Cost Mean')
@@ -159,14 +435,33 @@ def randWorkload():
     parser.add_argument('--checks-per-sec', type=int,
                         help="Checks per second")
 
+    parser.add_argument('--arrival', choices=['fixed', 'poisson', 'mmpp'], default='fixed',
+                        help='Arrival process of the checks (fixed meters --load or uses a fixed --checks-per-sec step).')
+    parser.add_argument('--burst-factor', type=float, default=10,
+                        help='How many times faster checks arrive in MMPP bursts.')
+    parser.add_argument('--burst-seconds', type=float, default=0.5,
+                        help='Mean length of MMPP bursts (seconds).')
+    parser.add_argument('--calm-seconds', type=float, default=5,
+                        help='Mean time between MMPP bursts (seconds).')
+
+    parser.add_argument('--trace', type=str,
+                        help='Replay the checks of a CSV file (time,cost,priority) instead of random ones.')
+    parser.add_argument('--trace-speedup', type=float, default=1.0,
+                        help='Divide the trace times by this factor.')
+
     parser.add_argument('file', type=str,
-                        help='Specify the workload output file.')
+                        help='Specify the workload output file (.gz or .xz to compress, - for stdout).')
 
     parser.add_argument('--validate',
                         default=False,
                         action='store_true',
                         help='Enable schema validator.')
 
+    parser.add_argument('--pretty',
+                        default=False,
+                        action='store_true',
+                        help='Indent the JSON events.')
+
     parser.add_argument('--prelude-only',
                         default=False,
                         action='store_true',
@@ -177,14 +472,30 @@ def randWorkload():
                         action='store_true',
                         help='Skip prelude')
 
+    parser.add_argument('--seed', type=int,
+                        help='Seed of the random checks.')
+
+    parser.add_argument('--shard-seconds', type=float,
+                        help='Generate the checks in shards of this many seconds in parallel.')
+
+    parser.add_argument('--jobs', type=int,
+                        help='Number of processes generating shards (default: all cores).')
 
     args = parser.parse_args()
 
-    if not ((args.load is None) ^ (args.checks_per_sec is None)):
-        print("Error: Must use --load or --checks-per-sec to define the workload but not both.")
+    if [args.load, args.checks_per_sec, args.trace].count(None) != 2:
+        print("Error: Must use one of --load, --checks-per-sec or --trace to define the workload.")
+        sys.exit(1)
+
+    if args.cost_dist == 'pareto' and args.cost_alpha <= 1:
+        print("Error: Pareto costs need --cost-alpha > 1 to have a mean.")
+        sys.exit(1)
+
+    if args.trace and args.shard_seconds is not None:
+        print("Error: Traces can't be sharded.")
         sys.exit(1)
 
-    w = Workload(args.validate)
+    w = Workload(args.file, args.validate, args.pretty)
 
     if not args.skip_prelude:
         w.changeVars(
@@ -201,30 +512,38 @@ def randWorkload():
         )
 
     if not args.prelude_only:
-        if args.load is not None:
-            loadFactor(w, args)
-        elif args.checks_per_sec is not None:
-            uniformChecks(w, args)
+        if args.trace:
+            traceChecks(w, args.trace, args.trace_speedup, args.sim_length * 10**6)
+        elif args.shard_seconds is not None:
+            randomShards(w, args)
+        else:
+            rng = np.random if args.seed is None else np.random.default_rng(args.seed)
+            randomGenerator(args)(w, args, rng=rng)
 
         w.endSim()
 
-    w.writeWorkload(args.file)
+    w.close()
 
 def genericWorkload():
     """ Create a generic workload based on the tasks defined in the EPA-RIMM paper """
     parser = argparse.ArgumentParser(description='Create a workload for an SMM Scheduler Simulator')
     scheduler.schedulerOptions(parser)
     parser.add_argument('file', type=str,
-                        help='Specify the workload output file.')
+                        help='Specify the workload output file (.gz or .xz to compress, - for stdout).')
 
     parser.add_argument('--validate',
                         default=False,
                         action='store_true',
                         help='Enable schema validator.')
 
+    parser.add_argument('--pretty',
+                        default=False,
+                        action='store_true',
+                        help='Indent the JSON events.')
+
     args = parser.parse_args()
 
-    w = Workload(args.validate)
+    w = Workload(args.file, args.validate, args.pretty)
 
     w.changeVars(
         {
@@ -253,4 +572,31 @@ def genericWorkload():
 
     w.endSim()
 
-    w.writeWorkload(args.file)
+    w.close()
+
+def mergeWorkload():
+    """ Merge several workloads into one by time """
+    parser = argparse.ArgumentParser(description='Merge SMM Scheduler Simulator workloads by time')
+    parser.add_argument('workloads', type=str, nargs='+',
+                        help='Workloads to merge, events at the same time keep this order.')
+    parser.add_argument('--output', type=str, default='-',
+                        help='Merged workload (.gz or .xz to compress, - for stdout).')
+    parser.add_argument('--prefix-groups',
+                        default=False,
+                        action='store_true',
+                        help='Prefix the check groups of every workload by its index.')
+    parser.add_argument('--validate',
+                        default=False,
+                        action='store_true',
+                        help='Enable schema validator.')
+    parser.add_argument('--pretty',
+                        default=False,
+                        action='store_true',
+                        help='Indent the JSON events.')
+
+    args = parser.parse_args()
+
+    streams = [jsonstream.iterWorkload(jsonstream.openWorkload(l)) for l in args.workloads]
+    with Workload(args.output, args.validate, args.pretty) as w:
+        for e in jsonstream.mergeWorkloads(streams, args.prefix_groups):
+            w.addEvent(e)
@@ -2,7 +2,36 @@
 """
 Setup.py
 """
+import os
+import subprocess
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+from setuptools.command.develop import develop
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def write_version(base):
+    """ Record the git revision in SMM/_version.py so tools don't run git on startup """
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd=HERE,
+                                      stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return
+    with open(os.path.join(base, 'SMM', '_version.py'), 'w') as f:
+        f.write("VERSION = {!r}\n".format(rev))
+
+class BuildPy(build_py):
+    def run(self):
+        build_py.run(self)
+        if not self.dry_run:
+            #Editable installs run from the checkout
+            write_version(HERE if getattr(self, 'editable_mode', False) else self.build_lib)
+
+class Develop(develop):
+    def run(self):
+        write_version(HERE)
+        develop.run(self)
 
 setup(
     name='SMM',
@@ -13,17 +42,26 @@ setup(
     scripts=[
     ],
     packages = find_packages(),
+    cmdclass={
+        'build_py': BuildPy,
+        'develop': Develop,
+    },
     entry_points={
         'console_scripts': [
             'smmsim = SMM.simulator:main',
             'smmbench = SMM.benchmarks:main',
             'smmgenwork = SMM.workload:genericWorkload',
             'smmrandwork = SMM.workload:randWorkload',
+            'smmmerge = SMM.workload:mergeWorkload',
             'smmvalidate = SMM.schema:validatestream',
+            'smmcompare = SMM.compare:main',
+            'smmanalyze = SMM.analyze:main',
         ],
     },
+    python_requires='>=3.8',
     install_requires=[
         'argparse',
+        'numpy',
         'pulp',
         'jsonschema',
     ]
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import subprocess as sp
-from SMM import scheduler
+from SMM import scheduler, sharedworkload
 import os
 import json
 from multiprocessing import Pool
@@ -43,19 +43,25 @@ def transpose_data_fmt(data, first_col=None):
 def transpose_data(table):
     return numpy.asarray(table).T.tolist()
 
-def run_sim(b, sim):
-    cmd = "cat results_{sim}/{bp}.prelude results_{sim}/sim.workload | smmsim /dev/stdin --sqllog results_{sim}/{bp}.log".format(bp=b, sim=sim)
-    os.system(cmd)
-
-def collect_result(b, fname):
-    json_result= sp.check_output(
-        "smmbench {fname}".format(fname=fname),
-        shell=True
+#Unchanged simulations are reused from here
+CACHE_DIR = ".smmcache"
+
+def run_sim(b, sim, shm):
+    sp.call(
+        [
+            "smmsim",
+            "results_{sim}/{bp}.prelude".format(bp=b, sim=sim),
+            "--shm", shm,
+            "--sqllog", "results_{sim}/{bp}.log".format(bp=b, sim=sim),
+            "--cache-dir", CACHE_DIR
+        ]
     )
-    return (b, json_result)
+
+def collect_results(fnames):
+    json_result = sp.check_output(["smmbench", "--update-cache", CACHE_DIR] + fnames)
+    return json.loads(json_result.decode())
 
 def main():
-    runsim = True
     binpackers = scheduler.getBinPackers()
     sim_time = 1000
 
@@ -69,47 +75,51 @@ def main():
     for s in sim:
         if not os.path.exists("results_{}".format(s)):
             os.mkdir("results_{}".format(s))
-        if runsim:
+        #Seeded, so the workloads are the same every time and the cache applies
+        sp.call(
+            [
+                "smmrandwork",
+                str(sim_time),
+                "results_{sim}/sim.workload".format(sim=s),
+                "--load={}".format(s / 100),
+                "--cost-mu", "25",
+                "--cost-sigma", "50",
+                "--priority-mu", "10",
+                "--priority-sigma", "10",
+                "--seed", str(s),
+                "--skip-prelude"
+            ]
+        )
+        for b in binpackers.keys():
             sp.call(
                 [
                     "smmrandwork",
+                    "--prelude-only",
+                    "--binpacker={bp}".format(bp=b),
+                    "--load={}".format(1),
                     str(sim_time),
-                    "results_{sim}/sim.workload".format(sim=s),
-                    "--load={}".format(s / 100),
-                    "--cost-mu", "25",
-                    "--cost-sigma", "50",
-                    "--priority-mu", "10",
-                    "--priority-sigma", "10",
-                    "--skip-prelude"
+                    "results_{sim}/{bp}.prelude".format(bp=b, sim=s)
                 ]
             )
-            for b in binpackers.keys():
-                sp.call(
-                    [
-                        "smmrandwork",
-                        "--prelude-only",
-                        "--binpacker={bp}".format(bp=b),
-                        "--load={}".format(1),
-                        str(sim_time),
-                        "results_{sim}/{bp}.prelude".format(bp=b, sim=s)
-                    ]
-                )
 
 
     benchmarks = {}
 
     p = Pool(5)
-    if runsim:
-        p.starmap(run_sim, [(b, s) for b in binpackers.keys() for s in sim])
+    #Parse every workload once for all the bin packers
+    shared = {s:sharedworkload.create(["results_{sim}/sim.workload".format(sim=s)]) for s in sim}
+    p.starmap(run_sim, [(b, s, shared[s].name) for b in binpackers.keys() for s in sim])
+    for shm in shared.values():
+        shm.close()
+        shm.unlink()
 
-    results = {}
-    for s in sim:
-        results[s] = p.starmap(collect_result, [(b, "results_{s}/{bp}.log".format(bp=b, s=s)) for b in binpackers.keys()])
+    logs = {(s, b):"results_{s}/{bp}.log".format(bp=b, s=s) for b in binpackers.keys() for s in sim}
+    results = collect_results(list(logs.values()))
 
     for s in sim:
         benchmarks[s] = {}
-        for b,v in results[s]:
-            benchmarks[s][b] = json.loads(v.decode())
+        for b in binpackers.keys():
+            benchmarks[s][b] = results[logs[(s, b)]]
 
     priorities = {}
     costs = {}